@@ -0,0 +1,45 @@
+from pathlib import Path
+import sys
+import bz2
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream_export import CompressedWriter, COMPRESSION_CODECS, normalize_tweet, zstandard  # noqa: E402
+from synthetic_tweets import generate_tweets  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', help='Number of tweets', type=int, default=20000)
+    parser.add_argument('-w', '--workers', help='Compression threads', type=int, default=None)
+    args = parser.parse_args()
+
+    start_ms = 1566604800000
+    lines = [normalize_tweet(raw) + "\n" for _, raw in generate_tweets(start_ms, start_ms + 86400000, args.number)]
+    raw_size = sum(len(line.encode('utf-8')) for line in lines)
+    results = {'tweets': args.number, 'uncompressed_bytes': raw_size}
+
+    # what init_script.sh used to do: single-threaded bzip2 --best on the whole file
+    start = time.perf_counter()
+    size = len(bz2.compress(''.join(lines).encode('utf-8'), 9))
+    results['bzip2_single_thread'] = {'seconds': round(time.perf_counter() - start, 3), 'bytes': size}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in COMPRESSION_CODECS:
+            if codec == 'zstd' and zstandard is None:
+                continue
+            file_name = Path(directory, 'twitter_stream.json{}'.format(COMPRESSION_CODECS[codec][0]))
+            start = time.perf_counter()
+            with CompressedWriter(file_name, codec, args.workers) as writer:
+                for line in lines:
+                    writer.write(line)
+            results[codec] = {'seconds': round(time.perf_counter() - start, 3), 'bytes': file_name.stat().st_size}
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+from pathlib import Path
+import sys
+import io
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream_export import write_tweets, athena_date, TWITTER_DATE_FORMAT, ATHENA_DATE_FORMAT  # noqa: E402
+from synthetic_tweets import generate_tweets  # noqa: E402
+
+
+def __gen_dict_extract(key, var):
+    if hasattr(var, 'items'):
+        for k, v in var.items():
+            if k == key:
+                yield v
+            if isinstance(v, dict):
+                for result in __gen_dict_extract(key, v):
+                    yield result
+            elif isinstance(v, list):
+                for d in v:
+                    for result in __gen_dict_extract(key, d):
+                        yield result
+
+
+def write_tweets_previous(json_lines, json_writer):
+    # the export loop as it was before twitter_stream_export
+    for json_line in json_lines:
+        tweet_json = json.loads(json_line)
+        for created_at in __gen_dict_extract('created_at', tweet_json):
+            json_line = json_line.replace(created_at,
+                                          datetime.strftime(datetime.strptime(created_at, TWITTER_DATE_FORMAT),
+                                                            ATHENA_DATE_FORMAT),
+                                          1)
+        json_writer.write("{}\n".format(json_line.strip("\r\n")))
+
+
+def run(function, database):
+    output = io.StringIO()
+    start = time.perf_counter()
+    function((row[0] for row in database.execute("select tweet_json from tweet order by tweet_id")), output)
+    return time.perf_counter() - start, output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', help='Number of tweets in the synthetic day', type=int, default=50000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database = sqlite3.connect(str(Path(directory, 'tweets.sqlite')), isolation_level=None)
+        database.execute("create table tweet (tweet_id integer primary key, tweet_json string)")
+        start_ms = 1566604800000
+        database.execute("begin")
+        database.executemany("insert or ignore into tweet (tweet_id, tweet_json) values (?, ?)",
+                             generate_tweets(start_ms, start_ms + 86400000, args.number))
+        database.execute("commit")
+
+        previous_seconds, previous_output = run(write_tweets_previous, database)
+        current_seconds, current_output = run(write_tweets, database)
+        database.close()
+
+    print(json.dumps({
+        'tweets': args.number,
+        'identical_output': previous_output == current_output,
+        'previous_seconds': round(previous_seconds, 3),
+        'current_seconds': round(current_seconds, 3),
+        'speedup': round(previous_seconds / current_seconds, 1),
+        'date_cache': athena_date.cache_info()._asdict()
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
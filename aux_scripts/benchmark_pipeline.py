@@ -0,0 +1,132 @@
+from pathlib import Path
+import sys
+import json
+import time
+import argparse
+import itertools
+import resource
+import tempfile
+import threading
+import tweepy
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream import TwitterStream, epoch_ms  # noqa: E402
+from twitter_stream_export import compressed_file_name  # noqa: E402
+from twitter_stream_metrics import METRICS  # noqa: E402
+from synthetic_tweets import generate_tweets  # noqa: E402
+
+
+CREDENTIALS = {'consumer_key': 'benchmark', 'consumer_secret': 'benchmark',
+               'access_token': 'benchmark', 'access_token_secret': 'benchmark'}
+
+
+class Replay:
+    # Stands in for tweepy.Stream.filter: hands the pre-generated messages of one shard to the real
+    # listener, as fast as possible or paced to a target rate. Once every shard is done, the pipeline is
+    # marked as finished, as when the time window ends, so that TwitterStream does not reconnect.
+    def __init__(self, messages, rate, shards):
+        self.messages = messages
+        self.rate = rate
+        self.shards = shards
+        self.shard_numbers = itertools.count()
+        self.done = threading.Barrier(shards)
+        self.elapsed = 0.0
+
+    def filter(self, stream, track=None, languages=None):
+        messages = self.messages[next(self.shard_numbers)::self.shards]
+        rate = self.rate / self.shards if self.rate else None
+        started = time.perf_counter()
+        for i, message in enumerate(messages):
+            if rate:
+                ahead = started + i / rate - time.perf_counter()
+                if ahead > 0:
+                    time.sleep(ahead)
+            if stream.listener.on_data(message) is False:
+                break
+        self.elapsed = max(self.elapsed, time.perf_counter() - started)
+        self.done.wait()
+        stream.listener.pipeline.finished.set()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; the export processes are reported as children
+    return {'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', help='Number of tweets in the day', type=int, default=100000)
+    parser.add_argument('-r', '--rate', help='Target messages per second (0: as fast as possible)', type=float,
+                        default=0)
+    parser.add_argument('-d', '--duplicates', help='Fraction of duplicated deliveries', type=float, default=0.02)
+    parser.add_argument('-e', '--nested', help='Fraction of retweets and of quotes', type=float, default=0.5)
+    parser.add_argument('-s', '--shards', help='Stream shards', type=int, default=1)
+    parser.add_argument('-b', '--batch-size', help='Tweets per SQLite transaction', type=int,
+                        default=TwitterStream.DEFAULT_BATCH_SIZE)
+    parser.add_argument('-t', '--writer-threads', help='Writer threads', type=int,
+                        default=TwitterStream.DEFAULT_WRITER_THREADS)
+    parser.add_argument('-w', '--workers', help='Export processes', type=int,
+                        default=TwitterStream.DEFAULT_EXPORT_WORKERS)
+    parser.add_argument('-z', '--compression', help='Compression of the JSON file',
+                        default=TwitterStream.DEFAULT_COMPRESSION)
+    parser.add_argument('-o', '--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        twitter_filter = {'name': 'benchmark', 'track': ','.join('term{}'.format(i) for i in range(args.shards)),
+                          'languages': ['en']}
+        credentials = {'odd_days': CREDENTIALS, 'even_days': CREDENTIALS,
+                       'shards': {'odd_days': [CREDENTIALS] * (args.shards - 1),
+                                  'even_days': [CREDENTIALS] * (args.shards - 1)}}
+        twitter_stream = TwitterStream(twitter_filter=twitter_filter, credentials=credentials,
+                                       batch_size=args.batch_size, writer_threads=args.writer_threads,
+                                       export_workers=args.workers, compression=args.compression,
+                                       work_dir=work_dir, shards=args.shards)
+
+        start_ms = epoch_ms(twitter_stream.start_saving)
+        end_ms = epoch_ms(twitter_stream.end_saving)
+        generated = time.perf_counter()
+        messages = [raw for _, raw in generate_tweets(start_ms, end_ms, args.number,
+                                                      duplicate_rate=args.duplicates, nested_rate=args.nested)]
+        generated = time.perf_counter() - generated
+        rss_after_generation = peak_rss_mb()['self']
+
+        replay = Replay(messages, args.rate, args.shards)
+        tweepy.Stream.filter = lambda stream, **kwargs: replay.filter(stream, **kwargs)
+        with METRICS.stage('ingest'):
+            twitter_stream.listen_to_tweets()
+        with METRICS.stage('prepare_database'):
+            twitter_stream.prepare_database()
+
+        json_file = Path(compressed_file_name(Path(work_dir, 'twitter_stream.json'), args.compression))
+        orc_file = Path(work_dir, 'twitter_stream.orc')
+        stages = {dict(key)['stage']: round(value, 3) for (name, key), value in METRICS.gauges.items()
+                  if name == 'twitter_stream_stage_seconds'}
+        report = {
+            'parameters': vars(args),
+            'messages': len(messages),
+            'message_bytes': sum(len(message) for message in messages),
+            'generation_seconds': round(generated, 3),
+            'on_data_per_second': round(len(messages) / replay.elapsed, 1) if replay.elapsed else None,
+            'ingest_per_second': round(len(messages) / stages['ingest'], 1) if stages['ingest'] else None,
+            'on_data_mean_us': round(METRICS.mean('twitter_stream_on_data_seconds') * 1e6, 2),
+            'sqlite_batch_mean_ms': round(METRICS.mean('twitter_stream_sqlite_write_seconds') * 1e3, 2),
+            'tweets_saved': METRICS.total('twitter_stream_tweets_total', status='saved'),
+            'tweets_duplicated': METRICS.total('twitter_stream_tweets_total', status='duplicate'),
+            'stage_seconds': stages,
+            'file_mb': {'sqlite': round(twitter_stream.db_name.stat().st_size / 2 ** 20, 2),
+                        'json': round(json_file.stat().st_size / 2 ** 20, 2),
+                        'orc': round(orc_file.stat().st_size / 2 ** 20, 2)},
+            'peak_rss_mb': dict(peak_rss_mb(), after_generation=rss_after_generation)
+        }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main()
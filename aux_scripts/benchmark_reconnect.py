@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+import sys
+import json
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream import TwitterStream, Backoff  # noqa: E402
+from mock_stream_server import make_server, create_certificate, FAILURES  # noqa: E402
+
+
+CREDENTIALS = {'consumer_key': 'benchmark', 'consumer_secret': 'benchmark',
+               'access_token': 'benchmark', 'access_token_secret': 'benchmark'}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', help='Seconds to collect', type=float, default=120)
+    parser.add_argument('-r', '--rate', help='Messages per second sent by the mock server', type=float, default=50)
+    parser.add_argument('-m', '--messages', help='Messages on each connection before a failure', type=int,
+                        default=200)
+    parser.add_argument('-f', '--failures', help='Failures to cycle through, separated by commas',
+                        default=','.join(FAILURES[:4]))
+    parser.add_argument('-s', '--stall-timeout', help='Seconds of silence that mean a stalled connection',
+                        type=float, default=5)
+    parser.add_argument('-u', '--outage-seconds', help='How long an outage failure lasts (with -f outage)',
+                        type=float, default=20)
+    parser.add_argument('-b', '--backoff-scale', help='Multiply every back off by this factor', type=float,
+                        default=0.05)
+    parser.add_argument('-p', '--port', help='Port of the mock server', type=int, default=8443)
+    parser.add_argument('-o', '--output', help='Also write the JSON report to this file')
+    args = parser.parse_args()
+
+    # shorter stalls and back offs than the real ones, so that every kind of failure shows up in a short run
+    TwitterStream.STALL_TIMEOUT = args.stall_timeout
+    for name in ('NETWORK_STEP', 'NETWORK_CAP', 'HTTP_START', 'HTTP_CAP', 'RATE_LIMIT_START', 'RATE_LIMIT_CAP'):
+        setattr(Backoff, name, getattr(Backoff, name) * args.backoff_scale)
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = create_certificate(directory)
+        server = make_server(args.port, certfile, keyfile, rate=args.rate, messages_per_connection=args.messages,
+                             failures=args.failures.split(','), stall_seconds=args.stall_timeout * 2,
+                             keep_alive=min(30, args.stall_timeout / 3), outage_seconds=args.outage_seconds)
+        threading.Thread(target=server.serve_forever, name="mock-stream-server", daemon=True).start()
+
+        twitter_filter = {'name': 'benchmark', 'track': 'term', 'languages': ['en']}
+        credentials = {'odd_days': CREDENTIALS, 'even_days': CREDENTIALS}
+        twitter_stream = TwitterStream(twitter_filter=twitter_filter, credentials=credentials,
+                                       work_dir=Path(directory, 'work'),
+                                       stream_host="127.0.0.1:{}".format(args.port), stream_verify=certfile)
+        # the mock server sends tweets created now: collect them until the duration is over
+        twitter_stream.start_saving = datetime.utcnow() - timedelta(minutes=1)
+        twitter_stream.end_saving = datetime.utcnow() + timedelta(seconds=args.duration)
+        twitter_stream.end_execution = twitter_stream.end_saving
+        twitter_stream.listen_to_tweets()
+        server.shutdown()
+
+        gaps = [gap for shard in twitter_stream.shards for gap in shard.gaps]
+        by_reason = {}
+        for gap in gaps:
+            by_reason.setdefault(gap['reason'], []).append(gap['seconds'])
+        report = {
+            'parameters': vars(args),
+            'connections': server.mock.connections,
+            'messages': sum(shard.received for shard in twitter_stream.shards),
+            'gap_seconds': {reason: {'count': len(seconds),
+                                     'mean': round(sum(seconds) / len(seconds), 3),
+                                     'max': max(seconds)} for reason, seconds in by_reason.items()},
+            'gaps': gaps
+        }
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main()
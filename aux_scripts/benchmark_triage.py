@@ -0,0 +1,59 @@
+from pathlib import Path
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream import triage_tweet, TWITTER_DATE_FORMAT  # noqa: E402
+from synthetic_tweets import generate_tweets  # noqa: E402
+
+
+def full_parse(raw_data):
+    # the original on_data path: whole payload through json.loads and created_at through strptime
+    data = json.loads(raw_data)
+    if 'in_reply_to_status_id' in data:
+        return data['id_str'], datetime.strptime(data['created_at'], TWITTER_DATE_FORMAT)
+    return None
+
+
+def measure(function, messages):
+    start = time.process_time()
+    for message in messages:
+        function(message)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', help='Number of messages', type=int, default=20000)
+    args = parser.parse_args()
+
+    start_ms = 1566604800000
+    messages = [raw for _, raw in generate_tweets(start_ms, start_ms + 86400000, args.number)]
+    messages.append('{"limit":{"track":42,"timestamp_ms":"1566604800123"}}')
+    messages.append('{"delete":{"status":{"id":1,"id_str":"1","user_id":2,"user_id_str":"2"},'
+                    '"timestamp_ms":"1566604800123"}}')
+
+    for message in messages:
+        expected = full_parse(message)
+        actual = triage_tweet(message)
+        if expected is None or actual is None:
+            assert expected == actual, message
+        else:
+            assert expected[0] == actual[0], message
+            assert datetime.utcfromtimestamp(actual[1] // 1000) == expected[1], message
+
+    full = measure(full_parse, messages)
+    fast = measure(triage_tweet, messages)
+    print(json.dumps({
+        'messages': len(messages),
+        'full_parse_us_per_message': round(full / len(messages) * 1e6, 2),
+        'triage_us_per_message': round(fast / len(messages) * 1e6, 2),
+        'speedup': round(full / fast, 1) if fast else None
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import sys
+import ssl
+import time
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from synthetic_tweets import generate_tweets  # noqa: E402
+
+
+# What the server does after sending messages_per_connection messages on a connection:
+# disconnect closes the socket, stall goes silent (not even keep-alive newlines) for stall_seconds before
+# closing, an HTTP status code closes the socket and answers the next connection attempt with that status,
+# outage closes the socket and every connection without an answer for outage_seconds (a network outage)
+# and none keeps sending forever
+FAILURES = ('disconnect', 'stall', '420', '503', 'outage', 'none')
+
+
+def create_certificate(directory):
+    # tweepy always connects with https: a self-signed certificate for localhost is enough for tests
+    certfile = str(Path(directory, 'mock_stream_cert.pem'))
+    keyfile = str(Path(directory, 'mock_stream_key.pem'))
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '7',
+                    '-keyout', keyfile, '-out', certfile, '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+class MockStream:
+    def __init__(self, rate, messages_per_connection, failures, stall_seconds, keep_alive, limit_every,
+                 outage_seconds=0):
+        self.rate = rate
+        self.messages_per_connection = messages_per_connection
+        self.failures = itertools.cycle(failures)
+        self.stall_seconds = stall_seconds
+        self.keep_alive = keep_alive
+        self.limit_every = limit_every
+        self.outage_seconds = outage_seconds
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.pending_status = None
+        self.down_until = 0
+
+    def next_connection(self):
+        # return the connection number and the HTTP status to answer with ('down' during an outage)
+        with self.lock:
+            self.connections = self.connections + 1
+            if time.monotonic() < self.down_until:
+                return self.connections, 'down', None
+            status = self.pending_status
+            self.pending_status = None
+            failure = next(self.failures) if status is None else None
+            return self.connections, status, failure
+
+    def fail_next_connection(self, status):
+        with self.lock:
+            self.pending_status = status
+
+    def start_outage(self):
+        with self.lock:
+            self.down_until = time.monotonic() + self.outage_seconds
+
+    def messages(self, connection):
+        now_ms = int(time.time() * 1000)
+        count = self.messages_per_connection
+        span_ms = int(count / self.rate * 1000) if self.rate else 1
+        undelivered = 0
+        for i, (_, raw) in enumerate(generate_tweets(now_ms, now_ms + span_ms, count, seed=connection)):
+            if self.limit_every and i > 0 and i % self.limit_every == 0:
+                undelivered = undelivered + self.limit_every
+                yield '{{"limit":{{"track":{},"timestamp_ms":"{}"}}}}'.format(undelivered, int(time.time() * 1000))
+            yield raw
+
+
+class MockStreamHandler(BaseHTTPRequestHandler):
+    # Answers POST /1.1/statuses/filter.json like the streaming API with delimited=length: each message is
+    # preceded by its length in bytes and followed by \r\n, and empty lines are keep-alive signals
+    def do_POST(self):
+        mock = self.server.mock
+        if not self.path.split('?')[0].endswith('/statuses/filter.json'):
+            self.send_error(404)
+            return
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        connection, status, failure = mock.next_connection()
+        if status == 'down':
+            logging.info("Connection %d: closed without an answer (outage)", connection)
+            self.close_connection = True
+            return
+        if status is not None:
+            logging.info("Connection %d: answer HTTP %d", connection, status)
+            self.send_error(status)
+            return
+
+        logging.info("Connection %d: send %d messages and then %s", connection, mock.messages_per_connection,
+                     failure)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            started = time.monotonic()
+            last_write = started
+            messages = mock.messages(connection)
+            if failure == 'none':
+                messages = itertools.chain.from_iterable(mock.messages(connection + i * 1000)
+                                                         for i in itertools.count())
+            for i, message in enumerate(messages):
+                if mock.rate:
+                    while True:
+                        ahead = started + i / mock.rate - time.monotonic()
+                        if ahead <= 0:
+                            break
+                        if time.monotonic() - last_write >= mock.keep_alive:
+                            self.wfile.write(b'\r\n')
+                            self.wfile.flush()
+                            last_write = time.monotonic()
+                        time.sleep(min(ahead, mock.keep_alive))
+                data = (message + '\r\n').encode('utf-8')
+                self.wfile.write('{}\r\n'.format(len(data)).encode('ascii') + data)
+                self.wfile.flush()
+                last_write = time.monotonic()
+            if failure == 'stall':
+                logging.info("Connection %d: stall for %.1f seconds", connection, mock.stall_seconds)
+                time.sleep(mock.stall_seconds)
+            elif failure == 'outage':
+                logging.info("Connection %d: outage for %.1f seconds", connection, mock.outage_seconds)
+                mock.start_outage()
+            elif failure.isdigit():
+                mock.fail_next_connection(int(failure))
+            logging.info("Connection %d: disconnect", connection)
+        except (BrokenPipeError, ConnectionResetError, ssl.SSLError):
+            logging.info("Connection %d: closed by the client", connection)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(port, certfile, keyfile, rate=50, messages_per_connection=1000, failures=FAILURES[:4],
+                stall_seconds=100, keep_alive=30, limit_every=0, host='127.0.0.1', outage_seconds=60):
+    server = ThreadingHTTPServer((host, port), MockStreamHandler)
+    server.daemon_threads = True
+    server.mock = MockStream(rate, messages_per_connection, failures, stall_seconds, keep_alive, limit_every,
+                             outage_seconds)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8443)
+    parser.add_argument('-r', '--rate', help='Messages per second (0: as fast as possible)', type=float, default=50)
+    parser.add_argument('-m', '--messages', help='Messages on each connection before a failure', type=int,
+                        default=1000)
+    parser.add_argument('-f', '--failures', help='Failures to cycle through, separated by commas: {}'.format(
+        ', '.join(FAILURES[:2] + FAILURES[4:]) + ' or an HTTP status'), default=','.join(FAILURES[:4]))
+    parser.add_argument('-s', '--stall-seconds', help='How long a stall lasts', type=float, default=100)
+    parser.add_argument('-u', '--outage-seconds', help='How long an outage lasts', type=float, default=60)
+    parser.add_argument('-k', '--keep-alive', help='Seconds between keep-alive newlines', type=float, default=30)
+    parser.add_argument('-l', '--limit-every', help='Send a limit notice every so many tweets', type=int,
+                        default=0)
+    parser.add_argument('--certfile', help='TLS certificate (a self-signed one is created if missing)')
+    parser.add_argument('--keyfile', help='TLS private key')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    failures = args.failures.split(',')
+    for failure in failures:
+        if failure not in FAILURES and not failure.isdigit():
+            parser.error("Unknown failure {}".format(failure))
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = args.certfile, args.keyfile
+        if certfile is None:
+            certfile, keyfile = create_certificate(directory)
+            logging.info("Self-signed certificate at %s (stream_verify in the config)", certfile)
+        server = make_server(args.port, certfile, keyfile, args.rate, args.messages, failures, args.stall_seconds,
+                             args.keep_alive, args.limit_every, outage_seconds=args.outage_seconds)
+        logging.info("Mock streaming API at https://127.0.0.1:%d/1.1/statuses/filter.json "
+                     "(stream_host 127.0.0.1:%d in the config)", args.port, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
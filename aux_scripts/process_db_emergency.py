@@ -1,48 +1,57 @@
+from datetime import datetime
 from pathlib import Path
+import sys
+import calendar
 import sqlite3
-import json
-from datetime import datetime
-
+import argparse
 
-__SELECT_UNIQUE_TWEETS = """
-select tweet_json
-from unique_tweet
-order by tweet_id
-"""
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream_export import export_new_tweets, export_new_tweets_by_hour, compressed_file_name, \
+    migrate_tweet_table, COMPRESSION_CODECS  # noqa: E402
 
 
-def __gen_dict_extract(key, var):
-    if hasattr(var, 'items'):
-        for k, v in var.items():
-            if k == key:
-                yield v
-            if isinstance(v, dict):
-                for result in __gen_dict_extract(key, v):
-                    yield result
-            elif isinstance(v, list):
-                for d in v:
-                    for result in __gen_dict_extract(key, d):
-                        yield result
+__INSERT_UNIQUE_TWEET = """
+insert or ignore into unique_tweet
+(tweet_id, tweet_json)
+select tweet_id, tweet_json
+from tweet
+"""
 
 
-db_name = Path(Path(__file__).parent, 'tmp', 'tweets.sqlite')
+parser = argparse.ArgumentParser()
+parser.add_argument('-w', '--workers', help='Number of export processes', type=int, default=1)
+parser.add_argument('-z', '--compression', help='Compression of the JSON file', choices=list(COMPRESSION_CODECS),
+                    default='bz2')
+parser.add_argument('-d', '--directory', help='Directory with tweets.sqlite (tmp/<filter name> for multiple filters)',
+                    default=str(Path(Path(__file__).parent, 'tmp')))
+parser.add_argument('-s', '--settle-seconds', help='Leave the tweets of the last seconds for the next run '
+                    '(when the collection is still running)', type=int, default=0)
+parser.add_argument('-f', '--full', help='Export every tweet again instead of continuing from the watermark',
+                    action='store_true')
+parser.add_argument('--hourly', help='One JSON and one ORC file per UTC hour in hours/HH (hourly_partitions)',
+                    action='store_true')
+args = parser.parse_args()
+
+db_name = Path(args.directory, 'tweets.sqlite')
 database = sqlite3.connect(str(db_name), isolation_level=None)
-database.row_factory = sqlite3.Row
-
-json_file = Path(Path(__file__).parent, 'tmp', 'twitter_stream.json')
-with open(json_file, 'w') as json_writer:
-    cursor_records = database.cursor()
-    cursor_records.execute(__SELECT_UNIQUE_TWEETS)
-    for record in cursor_records:
-        # standardize all dates to PrestoDB/Athena format
-        json_line = record['tweet_json']
-        tweet_json = json.loads(json_line)
-        for created_at in __gen_dict_extract('created_at', tweet_json):
-            json_line = json_line.replace(created_at,
-                                          datetime.strftime(datetime.strptime(created_at,
-                                                                              '%a %b %d %H:%M:%S +0000 %Y'),
-                                                            '%Y-%m-%d %H:%M:%S'),
-                                          1)
-        json_writer.write("{}\n".format(json_line.strip("\r\n")))
 
+# tweets are deduplicated at ingest; day files from older versions still need the copy into unique_tweet
+table = 'tweet'
+if database.execute("select 1 from sqlite_master where type = 'table' and name = 'unique_tweet'").fetchone():
+    database.execute(__INSERT_UNIQUE_TWEET)
+    table = 'unique_tweet'
+migrate_tweet_table(database, table)
+creation_date = database.execute("select creation_date from athena_prefix").fetchone()[0]
 database.close()
+
+json_file = compressed_file_name(Path(args.directory, 'twitter_stream.json'), args.compression)
+orc_file = Path(args.directory, 'twitter_stream.orc')
+if args.hourly:
+    day_start_ms = calendar.timegm(datetime.strptime(creation_date, '%Y-%m-%d').timetuple()) * 1000
+    export_new_tweets_by_hour(db_name=db_name, work_dir=args.directory, day_start_ms=day_start_ms,
+                              json_name=Path(json_file).name, orc_name=orc_file.name, workers=args.workers,
+                              table=table, compression=args.compression, settle_ms=args.settle_seconds * 1000,
+                              rebuild=args.full)
+else:
+    export_new_tweets(db_name=db_name, json_file=json_file, orc_file=orc_file, workers=args.workers, table=table,
+                      compression=args.compression, settle_ms=args.settle_seconds * 1000, rebuild=args.full)
@@ -0,0 +1,71 @@
+from pathlib import Path
+from datetime import datetime
+import sys
+import json
+import random
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream_export import tweet_id_from_ms  # noqa: E402
+
+
+SAMPLE_TWEET = Path(Path(__file__).parent.parent, 'sample', 'tweet.json')
+
+
+def __to_twitter_date(value):
+    return datetime.strftime(datetime.strptime(value, '%Y-%m-%d %H:%M:%S'), '%a %b %d %H:%M:%S +0000 %Y')
+
+
+def __restore_dates(var):
+    # sample/tweet.json was saved after normalization: bring created_at back to the format Twitter sends
+    if isinstance(var, dict):
+        for k, v in var.items():
+            if k == 'created_at' and isinstance(v, str):
+                var[k] = __to_twitter_date(v)
+            else:
+                __restore_dates(v)
+    elif isinstance(var, list):
+        for v in var:
+            __restore_dates(v)
+
+
+def load_sample_tweet():
+    with open(SAMPLE_TWEET) as sample_file:
+        tweet = json.load(sample_file)
+    __restore_dates(tweet)
+    return tweet
+
+
+def generate_tweets(start_ms, end_ms, count, duplicate_rate=0.0, nested_rate=0.5, num_users=10000, seed=0):
+    # Yield (tweet_id, raw_json) pairs with increasing ids spread over [start_ms, end_ms), in the same
+    # compact format and key order as the streaming API (timestamp_ms as the last key, as a string)
+    rnd = random.Random(seed)
+    template = load_sample_tweet()
+    template.pop('timestamp_ms', None)
+    retweeted_status = template.pop('retweeted_status', None)
+    quoted_status = template.pop('quoted_status', None)
+    user_dates = [datetime.strftime(datetime.utcfromtimestamp(1230768000 + rnd.randrange(300000000)),
+                                    '%a %b %d %H:%M:%S +0000 %Y') for _ in range(num_users)]
+    step = max((end_ms - start_ms) / max(count, 1), 1e-3)
+    previous = None
+    for i in range(count):
+        if previous is not None and rnd.random() < duplicate_rate:
+            yield previous
+            continue
+        timestamp_ms = int(start_ms + i * step)
+        # the sequence number of the millisecond fills the 12 lowest bits of the id
+        tweet_id = tweet_id_from_ms(timestamp_ms) + i % 4096
+        tweet = dict(template)
+        tweet['created_at'] = datetime.strftime(datetime.utcfromtimestamp(timestamp_ms // 1000),
+                                                '%a %b %d %H:%M:%S +0000 %Y')
+        tweet['id'] = tweet_id
+        tweet['id_str'] = str(tweet_id)
+        user_number = rnd.randrange(num_users)
+        tweet['user'] = dict(template['user'], id=user_number, id_str=str(user_number),
+                             created_at=user_dates[user_number])
+        if retweeted_status is not None and rnd.random() < nested_rate:
+            tweet['retweeted_status'] = retweeted_status
+        if quoted_status is not None and rnd.random() < nested_rate:
+            tweet['quoted_status'] = quoted_status
+        tweet['timestamp_ms'] = str(timestamp_ms)
+        previous = (tweet['id_str'], json.dumps(tweet, separators=(',', ':')))
+        yield previous
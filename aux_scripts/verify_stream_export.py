@@ -0,0 +1,160 @@
+from pathlib import Path
+import os
+import sys
+import json
+import argparse
+import tempfile
+import boto3
+import tweepy
+import pyarrow
+import pyarrow.orc
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from twitter_stream import TwitterStream, epoch_ms  # noqa: E402
+from twitter_stream_export import compressed_file_name  # noqa: E402
+from twitter_stream_uploader import TwitterStreamUploader, MultipartUploader, AthenaDdlCache, s3_key  # noqa: E402
+from benchmark_pipeline import Replay, CREDENTIALS  # noqa: E402
+from synthetic_tweets import generate_tweets  # noqa: E402
+
+# Checks stream_export against an S3 mocked by moto (pip install moto): a day whose upload is interrupted
+# is resumed keeping the parts S3 already has, the objects match the files of the disk export, and a day
+# already in S3 is not sent again but still has its partition added.
+
+BUCKET = 'verify-stream-export'
+# not us-east-1, whose buckets have no LocationConstraint to compare with the Athena region
+REGION = 'eu-west-1'
+
+
+class FakeAthena:
+    # records the queries instead of running them
+    def __init__(self):
+        self.queries = []
+
+    def query_athena_and_wait(self, query_string):
+        self.queries.append(query_string)
+
+
+class CountingParts:
+    # Stands in for MultipartUploader.upload_part: counts the parts sent and fails once fail_after are sent
+    def __init__(self, fail_after=None):
+        self.upload_part = MultipartUploader.upload_part
+        self.fail_after = fail_after
+        self.sent = 0
+
+    def __call__(self, uploader, *args):
+        if self.fail_after is not None and self.sent >= self.fail_after:
+            raise ConnectionError("Simulated network failure after {} parts".format(self.sent))
+        self.sent = self.sent + 1
+        return self.upload_part(uploader, *args)
+
+
+def mock_s3():
+    try:
+        from moto import mock_aws
+    except ImportError:
+        # moto < 5
+        from moto import mock_s3 as mock_aws
+    return mock_aws()
+
+
+def decompress(data, compression):
+    # the files are concatenated streams, one per compressed block
+    import bz2
+    import gzip
+    if compression == 'bz2':
+        return bz2.decompress(data)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True).read()
+    return data
+
+
+def save_to_s3(uploader, counting_parts):
+    MultipartUploader.upload_part = lambda uploader, *args: counting_parts(uploader, *args)
+    try:
+        return uploader.save_to_s3()
+    finally:
+        MultipartUploader.upload_part = counting_parts.upload_part
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', help='Number of tweets in the day', type=int, default=2000)
+    parser.add_argument('-z', '--compression', help='Compression of the JSON file', default='none')
+    parser.add_argument('-f', '--fail-after', help='Parts sent before the simulated failure', type=int, default=2)
+    args = parser.parse_args()
+
+    os.environ.update(AWS_ACCESS_KEY_ID='verify', AWS_SECRET_ACCESS_KEY='verify', AWS_DEFAULT_REGION=REGION)
+    with tempfile.TemporaryDirectory() as work_dir, mock_s3():
+        # collect a day and export it to disk as usual: the reference for the streamed objects
+        twitter_filter = {'name': 'verify', 'track': 'term', 'languages': ['en']}
+        twitter_stream = TwitterStream(twitter_filter=twitter_filter,
+                                       credentials={'odd_days': CREDENTIALS, 'even_days': CREDENTIALS},
+                                       compression=args.compression, work_dir=work_dir)
+        messages = [raw for _, raw in generate_tweets(epoch_ms(twitter_stream.start_saving),
+                                                      epoch_ms(twitter_stream.end_saving), args.number)]
+        replay = Replay(messages, 0, 1)
+        tweepy.Stream.filter = lambda stream, **kwargs: replay.filter(stream, **kwargs)
+        twitter_stream.listen_to_tweets()
+        twitter_stream.prepare_database()
+
+        s3 = boto3.client('s3')
+        s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': REGION})
+        # the smallest part size S3 accepts, so that the day takes several parts
+        uploader = TwitterStreamUploader(s3_bucket=BUCKET, athena_db='verify', aws_region=REGION,
+                                         compression=args.compression, part_size_mb=5, upload_concurrency=2,
+                                         work_dir=work_dir, stream_export=True)
+        json_key = s3_key('twitter_stream_raw', twitter_filter['name'], twitter_stream.creation_date,
+                          compressed_file_name('twitter_stream.json', args.compression))
+        orc_key = s3_key('twitter_stream', twitter_filter['name'], twitter_stream.creation_date,
+                         'twitter_stream.orc')
+
+        interrupted = CountingParts(fail_after=args.fail_after)
+        try:
+            save_to_s3(uploader, interrupted)
+            failed = False
+        except ConnectionError:
+            failed = True
+        resumed = CountingParts()
+        resumed_saved = save_to_s3(uploader, resumed)
+        again = CountingParts()
+        again_saved = save_to_s3(uploader, again)
+        athena = FakeAthena()
+        uploader.recreate_athena_table(athena=athena, ddl_cache=AthenaDdlCache(s3_bucket=BUCKET, athena_db='verify'))
+
+        json_file = Path(compressed_file_name(Path(work_dir, 'twitter_stream.json'), args.compression))
+        s3_json = s3.get_object(Bucket=BUCKET, Key=json_key)['Body'].read()
+        s3_orc = s3.get_object(Bucket=BUCKET, Key=orc_key)['Body'].read()
+        # a multipart ETag ends with the number of parts
+        parts = sum(int(etag.partition('-')[2] or 1) for etag in
+                    (s3.head_object(Bucket=BUCKET, Key=key)['ETag'].strip('"') for key in (json_key, orc_key)))
+        checks = {
+            'interrupted': failed,
+            'resume kept the parts already sent': 0 < interrupted.sent and resumed.sent == parts - interrupted.sent,
+            'resumed day saved': resumed_saved is True,
+            'json matches the disk export': decompress(s3_json, args.compression) ==
+                                            decompress(json_file.read_bytes(), args.compression),
+            'orc matches the disk export': pyarrow.orc.read_table(pyarrow.BufferReader(s3_orc)).equals(
+                pyarrow.orc.read_table(str(Path(work_dir, 'twitter_stream.orc')))),
+            'no multipart upload left': not s3.list_multipart_uploads(Bucket=BUCKET).get('Uploads'),
+            'day already in S3 not sent again': again.sent == 0,
+            'day already in S3 reported as saved': again_saved is True,
+            'partition added': any('ADD' in query.upper() and twitter_stream.creation_date in query
+                                   for query in athena.queries)
+        }
+        report = {
+            'parameters': vars(args),
+            'parts': parts,
+            'parts_sent': {'interrupted': interrupted.sent, 'resumed': resumed.sent, 'again': again.sent},
+            'object_mb': {'json': round(len(s3_json) / 2 ** 20, 2), 'orc': round(len(s3_orc) / 2 ** 20, 2)},
+            'checks': checks
+        }
+
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,18 @@
 #!/bin/bash
 sudo timedatectl set-timezone UTC
 sudo apt-get update -y
-sudo apt-get install -y python3-pip openjdk-8-jre
+sudo apt-get install -y python3-pip
 cd /home/ubuntu
 mkdir tmp
-wget https://repo1.maven.org/maven2/org/apache/orc/orc-tools/1.6.2/orc-tools-1.6.2-uber.jar -P ./tmp/
 wget https://raw.githubusercontent.com/internet-scholar/twitter_stream/master/requirements.txt
 wget https://raw.githubusercontent.com/internet-scholar/twitter_stream/master/twitter_stream.py
+wget https://raw.githubusercontent.com/internet-scholar/twitter_stream/master/twitter_stream_export.py
+wget https://raw.githubusercontent.com/internet-scholar/twitter_stream/master/twitter_stream_metrics.py
 wget https://raw.githubusercontent.com/internet-scholar/twitter_stream/master/twitter_stream_uploader.py
 wget https://raw.githubusercontent.com/internet-scholar/internet_scholar/master/requirements.txt -O requirements2.txt
 wget https://raw.githubusercontent.com/internet-scholar/internet_scholar/master/internet_scholar.py
 pip3 install --trusted-host pypi.python.org -r /home/ubuntu/requirements.txt
 pip3 install --trusted-host pypi.python.org -r /home/ubuntu/requirements2.txt
 python3 /home/ubuntu/twitter_stream.py -c $1 && \
-java -jar /home/ubuntu/tmp/orc-tools-1.6.2-uber.jar convert /home/ubuntu/tmp/twitter_stream.json -o /home/ubuntu/tmp/twitter_stream.orc -s 'struct<created_at:timestamp,id:bigint,id_str:string,text:string,source:string,truncated:boolean,in_reply_to_status_id:bigint,in_reply_to_status_id_str:string,in_reply_to_user_id:bigint,in_reply_to_user_id_str:string,in_reply_to_screen_name:string,quoted_status_id:bigint,quoted_status_id_str:string,is_quote_status:boolean,retweet_count:int,favorite_count:int,favorited:boolean,retweeted:boolean,possibly_sensitive:boolean,filter_level:string,lang:string,user:struct<id:bigint,id_str:string,name:string,screen_name:string,location:string,url:string,description:string,protected:boolean,verified:boolean,followers_count:int,friends_count:int,listed_count:int,favourites_count:int,statuses_count:int,created_at:timestamp,profile_banner_url:string,profile_image_url_https:string,default_profile:boolean,default_profile_image:boolean,withheld_in_countries:array<string>,withheld_scope:string>,coordinates:struct<coordinates:array<float>,type:string>,place:struct<id:string,url:string,place_type:string,name:string,full_name:string,country_code:string,country:string,bounding_box:struct<coordinates:array<array<array<float>>>,type:string>>,entities:struct<hashtags:array<struct<indices:array<smallint>,text:string>>,urls:array<struct<display_url:string,expanded_url:string,indices:array<smallint>,url:string>>,user_mentions:array<struct<id:bigint,id_str:string,indices:array<smallint>,name:string,screen_name:string>>,symbols:array<struct<indices:array<smallint>,text:string>>,media:array<struct<display_url:string,expanded_url:string,id:bigint,id_str:string,indices:array<smallint>,media_url:string,media_url_https:string,source_status_id:bigint,source_status_id_str:string,type:string,url:string>>>,quoted_status:struct<created_at:timestamp,id:bigint,id_str:string,text:string,source:string,truncated:boolean,in_reply_to_status_id:bigint,in_reply_to_status_id_str:string,in_reply_to_user_id:bigint,in_reply_to_user_id_str:string,in_reply_to_screen_name:string,quoted_status_id:bigint,quoted_status_id_str:string,is_quote_status:boolean,retweet_count:int,favorite_count:int,favorited:boolean,retweeted:boolean,possibly_sensitive:boolean,filter_level:string,lang:string,user:struct<id:bigint,id_str:string,name:string,screen_name:string,location:string,url:string,description:string,protected:boolean,verified:boolean,followers_count:int,friends_count:int,listed_count:int,favourites_count:int,statuses_count:int,created_at:timestamp,profile_banner_url:string,profile_image_url_https:string,default_profile:boolean,default_profile_image:boolean,withheld_in_countries:array<string>,withheld_scope:string>,coordinates:struct<coordinates:array<float>,type:string>,place:struct<id:string,url:string,place_type:string,name:string,full_name:string,country_code:string,country:string,bounding_box:struct<coordinates:array<array<array<float>>>,type:string>>,entities:struct<hashtags:array<struct<indices:array<smallint>,text:string>>,urls:array<struct<display_url:string,expanded_url:string,indices:array<smallint>,url:string>>,user_mentions:array<struct<id:bigint,id_str:string,indices:array<smallint>,name:string,screen_name:string>>,symbols:array<struct<indices:array<smallint>,text:string>>,media:array<struct<display_url:string,expanded_url:string,id:bigint,id_str:string,indices:array<smallint>,media_url:string,media_url_https:string,source_status_id:bigint,source_status_id_str:string,type:string,url:string>>>>,retweeted_status:struct<created_at:timestamp,id:bigint,id_str:string,text:string,source:string,truncated:boolean,in_reply_to_status_id:bigint,in_reply_to_status_id_str:string,in_reply_to_user_id:bigint,in_reply_to_user_id_str:string,in_reply_to_screen_name:string,quoted_status_id:bigint,quoted_status_id_str:string,is_quote_status:boolean,retweet_count:int,favorite_count:int,favorited:boolean,retweeted:boolean,possibly_sensitive:boolean,filter_level:string,lang:string,user:struct<id:bigint,id_str:string,name:string,screen_name:string,location:string,url:string,description:string,protected:boolean,verified:boolean,followers_count:int,friends_count:int,listed_count:int,favourites_count:int,statuses_count:int,created_at:timestamp,profile_banner_url:string,profile_image_url_https:string,default_profile:boolean,default_profile_image:boolean,withheld_in_countries:array<string>,withheld_scope:string>,coordinates:struct<coordinates:array<float>,type:string>,place:struct<id:string,url:string,place_type:string,name:string,full_name:string,country_code:string,country:string,bounding_box:struct<coordinates:array<array<array<float>>>,type:string>>,entities:struct<hashtags:array<struct<indices:array<smallint>,text:string>>,urls:array<struct<display_url:string,expanded_url:string,indices:array<smallint>,url:string>>,user_mentions:array<struct<id:bigint,id_str:string,indices:array<smallint>,name:string,screen_name:string>>,symbols:array<struct<indices:array<smallint>,text:string>>,media:array<struct<display_url:string,expanded_url:string,id:bigint,id_str:string,indices:array<smallint>,media_url:string,media_url_https:string,source_status_id:bigint,source_status_id_str:string,type:string,url:string>>>>>' 2>&1 | tee /home/ubuntu/tmp/orc_output.log && \
-bzip2 -z --best /home/ubuntu/tmp/twitter_stream.json 2>&1 | tee /home/ubuntu/tmp/bzip2_output.log && \
 python3 /home/ubuntu/twitter_stream_uploader.py -c $1 && \
 sudo shutdown -h now
\ No newline at end of file
@@ -1,62 +1,698 @@
 from datetime import datetime, time, timedelta
+import time as clock
+import calendar
 import tweepy
 import json
+import socket
+import requests
+import urllib3
 import sqlite3
+import shutil
+import signal
 from internet_scholar import read_dict_from_s3_url, AthenaLogger
+from twitter_stream_export import TWITTER_DATE_FORMAT, export_tweets, export_new_tweets, compressed_file_name, \
+    slim_tweet, compress_tweet, TweetCompressor, export_new_tweets_by_hour, stored_dictionaries
+from twitter_stream_uploader import create_uploader, set_s3_endpoint, twitter_filters, run_concurrently, \
+    TwitterFilter, orc_options
+from twitter_stream_metrics import METRICS, GAP_BUCKETS, MetricsReporter, start_metrics_server, directory_size, \
+    configure_profiler
 from pathlib import Path
 import argparse
 import logging
+import queue
+import threading
+from collections import deque
 
 
-num_exceptions = 0
+def epoch_ms(utc_datetime):
+    return calendar.timegm(utc_datetime.timetuple()) * 1000
 
 
-class TwitterListener(tweepy.StreamListener):
+def triage_tweet(raw_data):
+    # Return (id_str, timestamp_ms) for tweets and None for any other message (deletes, limits, warnings...).
+    # Twitter sends compact JSON that starts with created_at and whose only timestamp_ms is the top-level one,
+    # so a few string searches are enough; anything unexpected falls back to the full parser.
+    if raw_data.startswith('{"created_at":"') and '"in_reply_to_status_id":' in raw_data:
+        id_start = raw_data.find('"id_str":"')
+        timestamp_start = raw_data.rfind('"timestamp_ms":"')
+        # the first id_str belongs to the tweet itself only if no nested object was opened before it
+        if id_start != -1 and timestamp_start != -1 and '{' not in raw_data[1:id_start]:
+            id_start = id_start + len('"id_str":"')
+            id_end = raw_data.find('"', id_start)
+            timestamp_start = timestamp_start + len('"timestamp_ms":"')
+            timestamp_ms = raw_data[timestamp_start:raw_data.find('"', timestamp_start)]
+            if timestamp_ms.isdigit():
+                return raw_data[id_start:id_end], int(timestamp_ms)
+    data = json.loads(raw_data)
+    if 'in_reply_to_status_id' not in data:
+        return None
+    if 'timestamp_ms' in data:
+        return data['id_str'], int(data['timestamp_ms'])
+    return data['id_str'], epoch_ms(datetime.strptime(data['created_at'], TWITTER_DATE_FORMAT))
+
+
+class TweetWriter:
     __INSERT_TWEET = """
-    insert into tweet
+    insert or ignore into tweet
     (tweet_id, tweet_json)
     values (?, ?)
     """
 
-    def __init__(self, database, start_saving, end_saving, end_execution):
-        super().__init__()
-        self.start_saving = start_saving
-        self.end_saving = end_saving
-        self.end_execution = end_execution
+    __INSERT_SLIM_TWEET = """
+    insert or ignore into tweet
+    (tweet_id, tweet_json, tweet_raw)
+    values (?, ?, ?)
+    """
+
+    __CREATE_TABLE_DICTIONARY = """
+    create table if not exists compression_dictionary
+    (dictionary blob)
+    """
+
+    __INSERT_DICTIONARY = """
+    insert into compression_dictionary (dictionary)
+    select ? where not exists (select 1 from compression_dictionary where dictionary = ?)
+    """
+
+    def __init__(self, database, batch_size, flush_interval, dedup_cache_size, rotator=None, filter_name='',
+                 slim=False, compressor=None):
         self.database = database
+        self.filter_name = filter_name
+        self.insert_tweet = self.__INSERT_SLIM_TWEET if slim else self.__INSERT_TWEET
+        self.compressor = compressor
+        self.dictionary_saved = False
+        self.rotator = rotator
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch = []
+        self.last_flush = clock.monotonic()
+        self.lock = threading.Lock()
+        # Duplicates come from reconnections and overlapping deliveries, so they are close to the original:
+        # remembering the most recent ids avoids most redundant writes and the primary key catches the rest
+        self.recent_ids = set()
+        self.recent_ids_order = deque()
+        self.dedup_cache_size = dedup_cache_size
+        self.duplicates = 0
+        if self.compressor is not None:
+            dictionaries = stored_dictionaries(self.database)
+            if dictionaries:
+                self.compressor.use_dictionary(dictionaries[-1])
 
-    def on_data(self, raw_data):
-        data = json.loads(raw_data)
-        if 'in_reply_to_status_id' in data:
-            created_at = datetime.strptime(data['created_at'], '%a %b %d %H:%M:%S +0000 %Y')
-            if self.start_saving <= created_at < self.end_saving:
-                self.database.execute(self.__INSERT_TWEET, (data['id_str'], raw_data))
-                global num_exceptions
-                num_exceptions = 0
-            elif created_at >= self.end_execution:
+    def add(self, tweet_id, *tweet):
+        with self.lock:
+            if tweet_id in self.recent_ids:
+                self.duplicates = self.duplicates + 1
+                METRICS.inc('twitter_stream_tweets_total', status='duplicate', filter=self.filter_name)
+                return
+            self.recent_ids.add(tweet_id)
+            self.recent_ids_order.append(tweet_id)
+            if len(self.recent_ids_order) > self.dedup_cache_size:
+                self.recent_ids.discard(self.recent_ids_order.popleft())
+            self.batch.append((int(tweet_id),) + tweet)
+            if len(self.batch) >= self.batch_size:
+                self.__flush()
+            else:
+                self.__flush_if_due()
+
+    def flush_if_due(self):
+        with self.lock:
+            self.__flush_if_due()
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def __flush_if_due(self):
+        if clock.monotonic() - self.last_flush >= self.flush_interval:
+            self.__flush()
+
+    def __flush(self):
+        if self.batch:
+            # one transaction (and one fsync) for the whole batch
+            started = clock.perf_counter()
+            self.database.execute("begin")
+            if self.compressor is not None and self.compressor.dictionary is not None and not self.dictionary_saved:
+                # the dictionary goes into the file with the first tweets it compressed, so that the file
+                # can always be read on its own (prepare_database, process_db_emergency.py)
+                self.database.execute(self.__CREATE_TABLE_DICTIONARY)
+                dictionary = self.compressor.dictionary.as_bytes()
+                self.database.execute(self.__INSERT_DICTIONARY, (dictionary, dictionary))
+                self.dictionary_saved = True
+            # with rotation the primary key only sees the current segment: leave out tweets of earlier ones
+            batch = self.batch if self.rotator is None else self.rotator.new_tweets(self.batch)
+            saved = self.database.executemany(self.insert_tweet, batch).rowcount
+            self.database.execute("commit")
+            if self.rotator is not None:
+                self.rotator.remember(batch)
+            METRICS.observe('twitter_stream_sqlite_write_seconds', clock.perf_counter() - started,
+                            filter=self.filter_name)
+            # tweets ignored by the primary key were already in the database
+            METRICS.inc('twitter_stream_tweets_total', saved, status='saved', filter=self.filter_name)
+            METRICS.inc('twitter_stream_tweets_total', len(self.batch) - saved, status='duplicate',
+                        filter=self.filter_name)
+            if self.rotator is not None:
+                self.rotator.tweets = self.rotator.tweets + len(batch)
+            self.batch = []
+        self.last_flush = clock.monotonic()
+        if self.rotator is not None and self.rotator.is_due():
+            self.database = self.rotator.rotate(self.database)
+            self.dictionary_saved = False
+
+
+class SegmentRotator:
+    # Closes the current segment database every rotation_minutes or rotation_tweets and hands it to
+    # process_segment on a background thread, so collection goes on while the segment is uploaded.
+    # A small database next to the segments keeps every tweet_id saved during the day and the number of
+    # the next segment, so that a tweet delivered again after a rotation is not exported twice and a
+    # restart neither reopens a segment nor reuses the name of one already uploaded.
+    __CREATE_TABLE_SEEN = """
+    create table if not exists seen
+    (tweet_id integer primary key)
+    """
+
+    __CREATE_TABLE_STATE = """
+    create table if not exists segment_state
+    (next_segment integer)
+    """
+
+    __SELECT_SEEN = """
+    select tweet_id from seen where tweet_id in ({})
+    """
+
+    def __init__(self, open_segment, process_segment, rotation_minutes, rotation_tweets, ids_file, pending=()):
+        self.open_segment = open_segment
+        self.process_segment = process_segment
+        self.rotation_seconds = rotation_minutes * 60 if rotation_minutes else None
+        self.rotation_tweets = rotation_tweets
+        self.ids = sqlite3.connect(str(ids_file), isolation_level=None, check_same_thread=False)
+        self.ids.execute("pragma journal_mode=wal")
+        self.ids.execute("pragma synchronous=normal")
+        self.ids.execute(self.__CREATE_TABLE_SEEN)
+        self.ids.execute(self.__CREATE_TABLE_STATE)
+        row = self.ids.execute("select next_segment from segment_state").fetchone()
+        self.number = row[0] if row is not None else 0
+        # segments of a previous run that were closed (or interrupted) before being uploaded
+        self.pending = list(pending)
+        self.tweets = 0
+        self.started = clock.monotonic()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.__work, name="segment-uploader", daemon=True)
+
+    def open(self):
+        self.thread.start()
+        for number in self.pending:
+            logging.info("Segment %d was left by a previous run: process it again", number)
+            self.queue.put(number)
+        return self.__next_segment()
+
+    def __next_segment(self):
+        # the number is taken before the file exists: a segment is never opened twice
+        self.ids.execute("begin")
+        self.ids.execute("delete from segment_state")
+        self.ids.execute("insert into segment_state (next_segment) values (?)", (self.number + 1,))
+        self.ids.execute("commit")
+        return self.open_segment(self.number)
+
+    def new_tweets(self, batch):
+        # the tweets of the batch that no segment of the day has yet (called by the writer, under its lock)
+        seen = set()
+        for i in range(0, len(batch), 500):
+            ids = [tweet[0] for tweet in batch[i:i + 500]]
+            seen.update(row[0] for row in self.ids.execute(self.__SELECT_SEEN.format(",".join("?" * len(ids))),
+                                                           ids))
+        return [tweet for tweet in batch if tweet[0] not in seen]
+
+    def remember(self, batch):
+        # after the segment committed: a crash in between leads to a duplicate, never to a lost tweet
+        self.ids.execute("begin")
+        self.ids.executemany("insert or ignore into seen (tweet_id) values (?)", ((tweet[0],) for tweet in batch))
+        self.ids.execute("commit")
+
+    def is_due(self):
+        if self.rotation_tweets and self.tweets >= self.rotation_tweets:
+            return True
+        return self.rotation_seconds is not None and clock.monotonic() - self.started >= self.rotation_seconds
+
+    def rotate(self, database):
+        database.close()
+        logging.info("Close segment %d with %d tweets", self.number, self.tweets)
+        self.queue.put(self.number)
+        self.number = self.number + 1
+        self.tweets = 0
+        self.started = clock.monotonic()
+        return self.__next_segment()
+
+    def close(self, database):
+        database.close()
+        logging.info("Close last segment %d with %d tweets and wait for %d segment(s) to be processed",
+                     self.number, self.tweets, self.queue.qsize() + 1)
+        self.queue.put(self.number)
+        self.queue.put(None)
+        self.thread.join()
+        self.ids.close()
+
+    def __work(self):
+        while True:
+            number = self.queue.get()
+            if number is None:
+                break
+            try:
+                self.process_segment(number)
+            except Exception:
+                # the segment database stays on disk and is processed again when the collector restarts
+                logging.exception("Could not process segment %d", number)
+
+
+DAY_MS = 24 * 3600 * 1000
+
+
+class DayRotator:
+    # Daemon mode: each UTC day of created_at has its own writer and database, opened by the first tweet of
+    # the day. A day is closed once tweets are delay_end_ms past its end (late tweets still reach it until
+    # then) and handed to process_day on a background thread, so the stream never stops at midnight. A day
+    # that fails is handed over again RETRY_SECONDS later, as the daemon is not restarted to pick it up.
+    RETRY_SECONDS = 600
+
+    def __init__(self, open_day, process_day, first_day_ms, delay_end_ms, flush_interval, filter_name=''):
+        self.open_day = open_day
+        self.process_day = process_day
+        self.delay_end_ms = delay_end_ms
+        self.flush_interval = flush_interval
+        # tweets of days before this one are too late: their day was closed (or belongs to a previous run)
+        self.closed_before = first_day_ms
+        self.writers = {}
+        self.closed_duplicates = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.labels = {'filter': filter_name}
+        # days handed over and not processed yet, and the timers of the failed ones
+        self.unprocessed = set()
+        self.retries = {}
+        self.closed = False
+        METRICS.set('twitter_stream_unprocessed_days', lambda: len(self.unprocessed), **self.labels)
+        self.thread = threading.Thread(target=self.__work, name="day-uploader", daemon=True)
+        self.thread.start()
+
+    @property
+    def duplicates(self):
+        with self.lock:
+            return self.closed_duplicates + sum(writer.duplicates for writer in self.writers.values())
+
+    def open_days(self):
+        with self.lock:
+            return sorted(self.writers)
+
+    def add(self, created_at, tweet_id, *tweet):
+        # Return False for a tweet whose day is already closed
+        day = created_at - created_at % DAY_MS
+        with self.lock:
+            for open_day in sorted(self.writers):
+                if open_day + DAY_MS + self.delay_end_ms <= created_at:
+                    self.__close(open_day)
+            if day < self.closed_before:
                 return False
+            writer = self.writers.get(day)
+            if writer is None:
+                writer = self.writers[day] = self.open_day(day)
+            writer.add(tweet_id, *tweet)
+            return True
+
+    def hand_over(self, day):
+        with self.lock:
+            self.unprocessed.add(day)
+        self.queue.put(day)
+
+    def flush_if_due(self):
+        with self.lock:
+            for writer in self.writers.values():
+                writer.flush_if_due()
+
+    def flush(self):
+        with self.lock:
+            for writer in self.writers.values():
+                writer.flush()
+
+    def __close(self, day):
+        writer = self.writers.pop(day)
+        writer.flush()
+        writer.database.close()
+        self.closed_duplicates = self.closed_duplicates + writer.duplicates
+        self.closed_before = max(self.closed_before, day + DAY_MS)
+        logging.info("Close day %s", datetime.utcfromtimestamp(day / 1000).strftime("%Y-%m-%d"))
+        self.unprocessed.add(day)
+        self.queue.put(day)
+
+    def close(self):
+        # on shutdown the open days stay on disk: the next run goes on writing into them
+        with self.lock:
+            for writer in self.writers.values():
+                writer.flush()
+                writer.database.close()
+            self.writers = {}
+            # the failed days waiting for their retry stay on disk too
+            self.closed = True
+            for timer in self.retries.values():
+                timer.cancel()
+            self.retries = {}
+        logging.info("Wait for %d day(s) to be processed", self.queue.qsize())
+        self.queue.put(None)
+        self.thread.join()
+
+    def __work(self):
+        while True:
+            day = self.queue.get()
+            if day is None:
+                break
+            try:
+                self.process_day(day)
+                with self.lock:
+                    self.unprocessed.discard(day)
+            except Exception:
+                logging.exception("Could not process day %s: try again in %d seconds",
+                                  datetime.utcfromtimestamp(day / 1000).date(), self.RETRY_SECONDS)
+                METRICS.inc('twitter_stream_day_failures_total', **self.labels)
+                self.__retry(day)
+
+    def __retry(self, day):
+        # the day stays on disk: hand it over again later, unless the daemon stops first
+        with self.lock:
+            if self.closed:
+                return
+            timer = threading.Timer(self.RETRY_SECONDS, self.__retry_now, args=(day,))
+            timer.daemon = True
+            self.retries[day] = timer
+            timer.start()
+
+    def __retry_now(self, day):
+        with self.lock:
+            if self.retries.pop(day, None) is None:
+                return
+        self.queue.put(day)
+
+
+class TweetPipeline:
+    def __init__(self, writer, start_saving, end_saving, end_execution, queue_size, num_workers, filter_name='',
+                 slim=False, compressor=None, days=None):
+        # in daemon mode, days (a DayRotator) stands in for the writer and routes each tweet to its day
+        self.days = days
+        self.writer = writer if days is None else days
+        self.filter_name = filter_name
+        self.slim = slim
+        self.compressor = compressor
+        # the time window is compared in epoch milliseconds against timestamp_ms
+        self.start_saving = epoch_ms(start_saving)
+        self.end_saving = epoch_ms(end_saving)
+        self.end_execution = epoch_ms(end_execution)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.num_workers = num_workers
+        self.workers = []
+        self.finished = threading.Event()
+        self.received = 0
+        self.queue_full = 0
+        self.queue_high_water = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        logging.info("Start %d writer thread(s) with a queue of %d messages", self.num_workers, self.queue.maxsize)
+        METRICS.set('twitter_stream_queue_size', self.queue.qsize, filter=self.filter_name)
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self.__work, name="tweet-writer-{}".format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, raw_data):
+        # every stream shard calls put from its own thread
+        full = False
+        try:
+            self.queue.put_nowait(raw_data)
+        except queue.Full:
+            full = True
+            self.queue.put(raw_data)
+        queue_size = self.queue.qsize()
+        with self.lock:
+            self.received = self.received + 1
+            if full:
+                self.queue_full = self.queue_full + 1
+            if queue_size > self.queue_high_water:
+                self.queue_high_water = queue_size
+
+    def stop(self):
+        logging.info("Drain %d queued messages", self.queue.qsize())
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.writer.flush()
+        logging.info("Messages received: %d - Queue high-water mark: %d of %d - Times queue was full: %d",
+                     self.received, self.queue_high_water, self.queue.maxsize, self.queue_full)
+        logging.info("Duplicated tweets skipped before reaching the database: %d", self.writer.duplicates)
+        if self.slim or self.compressor is not None:
+            tweets = METRICS.total('twitter_stream_stored_tweets_total', filter=self.filter_name)
+            received = METRICS.total('twitter_stream_payload_bytes_total', kind='received', filter=self.filter_name)
+            stored = METRICS.total('twitter_stream_payload_bytes_total', kind='stored', filter=self.filter_name)
+            if tweets:
+                logging.info("Storage (slim %s, blob compression %s): %.0f bytes per tweet received, %.0f stored: "
+                             "%.0f bytes (%.1f%%) saved per tweet", self.slim, self.compressor is not None,
+                             received / tweets, stored / tweets, (received - stored) / tweets,
+                             100.0 * (received - stored) / received)
+
+    def __work(self):
+        while True:
+            try:
+                raw_data = self.queue.get(timeout=self.writer.flush_interval)
+            except queue.Empty:
+                self.writer.flush_if_due()
+                continue
+            if raw_data is None:
+                break
+            self.__process(raw_data)
+
+    def __process(self, raw_data):
+        tweet = triage_tweet(raw_data)
+        if tweet is not None:
+            tweet_id, timestamp_ms = tweet
+            # truncate to whole seconds, the precision of created_at
+            created_at = timestamp_ms - timestamp_ms % 1000
+            if self.days is not None:
+                if not self.days.add(created_at, tweet_id, *self.__stored(raw_data)):
+                    METRICS.inc('twitter_stream_tweets_total', status='out_of_window', filter=self.filter_name)
+            elif self.start_saving <= created_at < self.end_saving:
+                self.writer.add(tweet_id, *self.__stored(raw_data))
+            else:
+                METRICS.inc('twitter_stream_tweets_total', status='out_of_window', filter=self.filter_name)
+                if created_at >= self.end_execution:
+                    self.finished.set()
+
+    def __stored(self, raw_data):
+        # slim storage and blob compression: the stored columns differ from the payload received
+        if not self.slim and self.compressor is None:
+            return (raw_data,)
+        if self.slim:
+            if self.compressor is not None:
+                tweet = (self.compressor.compress(slim_tweet(raw_data)), self.compressor.compress(raw_data))
+            else:
+                tweet = (slim_tweet(raw_data), compress_tweet(raw_data))
+        else:
+            tweet = (self.compressor.compress(raw_data),)
+        METRICS.inc('twitter_stream_stored_tweets_total', filter=self.filter_name)
+        METRICS.inc('twitter_stream_payload_bytes_total', len(raw_data.encode('utf-8')), kind='received',
+                    filter=self.filter_name)
+        METRICS.inc('twitter_stream_payload_bytes_total',
+                    sum(len(value.encode('utf-8')) if isinstance(value, str) else len(value) for value in tweet),
+                    kind='stored', filter=self.filter_name)
+        return tweet
+
+
+class StreamError(Exception):
+    pass
+
+
+class Backoff:
+    # Twitter's reconnection rules: back off linearly from 250 ms up to 16 seconds after network errors
+    # and stalls, exponentially from 5 seconds up to 320 seconds after HTTP errors and exponentially
+    # from one minute after a 420 (too many connections)
+    NETWORK_STEP = 0.25
+    NETWORK_CAP = 16
+    HTTP_START = 5
+    HTTP_CAP = 320
+    RATE_LIMIT_START = 60
+    RATE_LIMIT_CAP = 960
+
+    def __init__(self):
+        self.network = 0
+        self.http = 0
+        self.rate_limit = 0
+
+    def reset(self):
+        self.network = 0
+        self.http = 0
+        self.rate_limit = 0
+
+    def next(self, reason):
+        if reason == 'rate_limit':
+            self.rate_limit = min(self.rate_limit * 2, self.RATE_LIMIT_CAP) if self.rate_limit else \
+                self.RATE_LIMIT_START
+            return self.rate_limit
+        if reason == 'http':
+            self.http = min(self.http * 2, self.HTTP_CAP) if self.http else self.HTTP_START
+            return self.http
+        self.network = min(self.network + self.NETWORK_STEP, self.NETWORK_CAP)
+        return self.network
+
+
+class StreamShard:
+    # One connection to the streaming API with its share of the track terms and its own credentials
+    def __init__(self, number, track_terms, credentials, filter_name=''):
+        self.number = number
+        self.labels = {'filter': filter_name, 'shard': number}
+        self.track_terms = track_terms
+        self.consumer_key = credentials['consumer_key']
+        self.consumer_secret = credentials['consumer_secret']
+        self.access_token = credentials['access_token']
+        self.access_token_secret = credentials['access_token_secret']
+        self.received = 0
+        self.last_message_at = None
+        self.last_tweet = None
+        self.gap = None
+        self.gaps = []
+        self.limit_notices = 0
+        self.undelivered = 0
+        self.connection_undelivered = 0
+        self.started = None
+        self.stopped = None
+
+    def add_limit_notice(self, raw_data):
+        # the track field of a limit notice counts the tweets not delivered since the connection started
+        self.limit_notices = self.limit_notices + 1
+        track = json.loads(raw_data)['limit'].get('track', 0)
+        self.undelivered = self.undelivered + track - self.connection_undelivered
+        self.connection_undelivered = track
+
+    def connect(self):
+        # the counts of limit notices start again with each connection
+        self.connection_undelivered = 0
+
+    def open_gap(self, reason):
+        # a gap goes from the last message of the failed connection to the first tweet of a new one
+        if self.gap is None:
+            started = self.last_message_at or clock.monotonic()
+            self.gap = {'reasons': [],
+                        'started': started,
+                        'started_at': datetime.utcnow() - timedelta(seconds=clock.monotonic() - started),
+                        'last_tweet': self.last_tweet}
+        self.gap['reasons'].append(reason)
+
+    def close_gap(self, raw_data):
+        gap = self.gap
+        self.gap = None
+        before = triage_tweet(gap['last_tweet']) if gap['last_tweet'] is not None else None
+        after = triage_tweet(raw_data)
+        record = {'shard': self.number,
+                  'reason': ','.join(gap['reasons']),
+                  'started_at': gap['started_at'].strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                  'seconds': round(clock.monotonic() - gap['started'], 3),
+                  'attempts': len(gap['reasons']),
+                  'last_tweet_id_before': before[0] if before is not None else None,
+                  'first_tweet_id_after': after[0] if after is not None else None}
+        self.gaps.append(record)
+        METRICS.observe('twitter_stream_gap_seconds', record['seconds'], buckets=GAP_BUCKETS, **self.labels)
+        logging.info("Gap on shard %d: %.2f seconds (%s, %d attempt(s)) - last tweet before: %s - "
+                     "first tweet after: %s", self.number, record['seconds'], record['reason'],
+                     record['attempts'], record['last_tweet_id_before'], record['first_tweet_id_after'])
+
+    def throughput(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.stopped or clock.monotonic()) - self.started
+        return self.received / elapsed if elapsed > 0 else 0.0
+
+
+def shard_credentials(credentials, shards):
+    # Every connection needs its own credentials: today's set comes first so that a single shard behaves as
+    # before, then the sets reserved for the extra shards of today (credentials['shards']['odd_days'] or
+    # ['even_days']). The other day's sets are never used: the VM of that day overlaps with this one around
+    # midnight and two connections with the same credentials get 420 or disconnect each other.
+    which_credentials = int(datetime.utcnow().timestamp() / 86400) % 2
+    day = 'odd_days' if which_credentials == 1 else 'even_days'
+    logging.info("Use %s Twitter credentials", "odd days'" if which_credentials == 1 else "even days'")
+    credential_sets = [credentials[day]] + credentials.get('shards', {}).get(day, [])
+    if shards > len(credential_sets):
+        raise ValueError("{} stream shards need {} credential sets reserved for shards under "
+                         "twitter_credentials.shards.{}: only {} available".format(
+                             shards, shards - 1, day, len(credential_sets) - 1))
+    return credential_sets[:shards]
+
+
+class TwitterListener(tweepy.StreamListener):
+    def __init__(self, pipeline, shard):
+        super().__init__()
+        self.pipeline = pipeline
+        self.shard = shard
+        self.status_code = None
+        self.stalled = False
+
+    def on_data(self, raw_data):
+        started = clock.perf_counter()
+        if self.pipeline.finished.is_set():
+            return False
+        self.shard.received = self.shard.received + 1
+        self.shard.last_message_at = clock.monotonic()
+        if raw_data.startswith('{"created_at"'):
+            self.shard.last_tweet = raw_data
+            if self.shard.gap is not None:
+                self.shard.close_gap(raw_data)
+        METRICS.inc('twitter_stream_messages_total', **self.shard.labels)
+        if raw_data.startswith('{"limit"'):
+            self.shard.add_limit_notice(raw_data)
+            METRICS.inc('twitter_stream_limit_notices_total', **self.shard.labels)
+        self.pipeline.put(raw_data)
+        METRICS.observe('twitter_stream_on_data_seconds', clock.perf_counter() - started, **self.shard.labels)
+
+    def on_error(self, status_code):
+        # stop tweepy from retrying on its own: TwitterStream backs off as Twitter asks and reconnects
+        self.status_code = status_code
+        return False
+
+    def on_timeout(self):
+        self.stalled = True
+        return False
+
+
+class StreamConnection(tweepy.Stream):
+    def on_closed(self, resp):
+        # tweepy would reconnect at once: end the connection and let TwitterStream back off first
+        raise StreamError("Connection closed by the server")
 
 
 class TwitterStream:
-    MAX_ATTEMPTS_TWITTER_STREAM = 10
+    # Twitter sends a keep-alive newline every 30 seconds: 90 seconds of silence means a stalled connection
+    STALL_TIMEOUT = 90
+    STALL_EXCEPTIONS = (requests.exceptions.Timeout, urllib3.exceptions.TimeoutError, socket.timeout)
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_FLUSH_INTERVAL = 5
+    DEFAULT_QUEUE_SIZE = 10000
+    DEFAULT_WRITER_THREADS = 1
+    DEFAULT_DEDUP_CACHE_SIZE = 100000
+    DEFAULT_EXPORT_WORKERS = 1
+    DEFAULT_COMPRESSION = 'bz2'
+    DEFAULT_STREAM_SHARDS = 1
+    DEFAULT_BLOB_COMPRESSION = 'none'
+    DEFAULT_EXPORT_SETTLE_SECONDS = 300
 
+    # tweet_id is the rowid: the table is stored in tweet_id order and the export reads it sequentially
     __CREATE_TABLE_TWEET = """
     create table tweet
-        (tweet_id string,
-        tweet_json string)
-    """
-
-    __CREATE_TABLE_UNIQUE_TWEET = """
-    create table unique_tweet
-        (tweet_id string primary key,
+        (tweet_id integer primary key,
         tweet_json string)
     """
 
-    __INSERT_UNIQUE_TWEET = """
-    insert or ignore into unique_tweet
-    (tweet_id, tweet_json)
-    select tweet_id, tweet_json
-    from tweet
+    # slim storage: tweet_json keeps the fields of STRUCTURE_TWEET_ATHENA and tweet_raw the compressed payload
+    __CREATE_TABLE_SLIM_TWEET = """
+    create table tweet
+        (tweet_id integer primary key,
+        tweet_json string,
+        tweet_raw blob)
     """
 
     __CREATE_TABLE_ATHENA_PREFIX = """
@@ -71,13 +707,17 @@ class TwitterStream:
     values (?, ?)
     """
 
-    __SELECT_UNIQUE_TWEETS = """
-    select tweet_json
-    from unique_tweet
-    order by tweet_id
-    """
-
-    def __init__(self, twitter_filter, credentials):
+    def __init__(self, twitter_filter, credentials,
+                 batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 queue_size=DEFAULT_QUEUE_SIZE, writer_threads=DEFAULT_WRITER_THREADS,
+                 dedup_cache_size=DEFAULT_DEDUP_CACHE_SIZE, export_workers=DEFAULT_EXPORT_WORKERS,
+                 compression=DEFAULT_COMPRESSION, compression_workers=None,
+                 rotation_minutes=None, rotation_tweets=None, uploader=None, work_dir=None,
+                 shards=DEFAULT_STREAM_SHARDS, stream_host=None, stream_verify=True, slim_storage=False,
+                 blob_compression=DEFAULT_BLOB_COMPRESSION, dictionary_samples=TweetCompressor.DEFAULT_SAMPLES,
+                 dictionary_size=TweetCompressor.DEFAULT_DICTIONARY_SIZE, export_interval_minutes=None,
+                 export_settle_seconds=DEFAULT_EXPORT_SETTLE_SECONDS, hourly_partitions=False, orc_options=None,
+                 daemon=False, stream_export=False, max_outage_minutes=None):
         logging.info('Create TwitterStream object')
 
         # The default options for the time frame are below... in case they are changed for debugging purposes
@@ -85,133 +725,469 @@ class TwitterStream:
         duration_saving = timedelta(days=1)
         delay_end = timedelta(minutes=1)
 
+        # the daemon starts with the current day and goes on day after day; otherwise collect the next day
+        self.daemon = daemon
         self.start_saving = datetime.combine(datetime.utcnow().date(), start_saving_time)
-        if self.start_saving <= datetime.utcnow():
+        if self.start_saving <= datetime.utcnow() and not self.daemon:
             self.start_saving = self.start_saving + timedelta(days=1)
         self.end_saving = self.start_saving + duration_saving
         self.end_execution = self.end_saving + delay_end
-        logging.info("Collect tweets from %s to %s. End execution at %s",
-                     self.start_saving, self.end_saving, self.end_execution)
+        if self.daemon:
+            logging.info("Collect tweets from %s on, one database per day, until stopped", self.start_saving)
+        else:
+            logging.info("Collect tweets from %s to %s. End execution at %s",
+                         self.start_saving, self.end_saving, self.end_execution)
 
         self.creation_date = self.start_saving.strftime("%Y-%m-%d")
 
-        which_credentials = int(datetime.utcnow().timestamp() / 86400) % 2
-        if which_credentials == 1:
-            logging.info("Use odd days' Twitter credentials")
-            credentials = credentials['odd_days']
-        else:
-            logging.info("Use even days' Twitter credentials")
-            credentials = credentials['even_days']
-        self.consumer_key = credentials['consumer_key']
-        self.consumer_secret = credentials['consumer_secret']
-        self.access_token = credentials['access_token']
-        self.access_token_secret = credentials['access_token_secret']
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        logging.info("Save tweets in batches of %d or every %d seconds", self.batch_size, self.flush_interval)
+        self.queue_size = queue_size
+        self.writer_threads = writer_threads
+        self.dedup_cache_size = dedup_cache_size
+        self.export_workers = export_workers
+        self.compression = compression
+        self.compression_workers = compression_workers
+        self.rotation_minutes = rotation_minutes
+        self.rotation_tweets = rotation_tweets
+        self.uploader = uploader
+        self.partition_added = False
+        if self.daemon and (self.rotation_minutes or self.rotation_tweets):
+            raise ValueError("Daemon mode does not work with segment rotation: days are uploaded as they end")
+        if self.rotation_minutes or self.rotation_tweets:
+            logging.info("Rotate segments every %s minutes or %s tweets", self.rotation_minutes, self.rotation_tweets)
+        self.hourly_partitions = hourly_partitions
+        if self.hourly_partitions and (self.rotation_minutes or self.rotation_tweets):
+            raise ValueError("Hourly partitions do not work with segment rotation: segments are uploaded by day")
+        self.orc_options = orc_options
+        # the uploader exports the database straight into S3: nothing is exported to disk here
+        self.stream_export = stream_export
+        if self.stream_export and (self.hourly_partitions or self.rotation_minutes or self.rotation_tweets):
+            raise ValueError("Streaming export uploads whole days: it does not work with hourly partitions "
+                             "or segment rotation")
+        if self.stream_export and export_interval_minutes:
+            logging.info("Streaming export: periodic exports to disk are turned off")
+            export_interval_minutes = None
+        self.export_interval_minutes = export_interval_minutes
+        self.export_settle_seconds = export_settle_seconds
+        if self.export_interval_minutes and not (self.rotation_minutes or self.rotation_tweets):
+            logging.info("Export new tweets every %s minutes, except those of the last %s seconds",
+                         self.export_interval_minutes, self.export_settle_seconds)
 
         self.filter = twitter_filter
         self.filter['track_terms'] = [x.strip() for x in self.filter['track'].split(',')]
         logging.info("Track terms: %s", self.filter)
 
-        self.db_name = Path(Path(__file__).parent, 'tmp', 'tweets.sqlite')
+        # Each connection has a delivery cap: split the track terms among several connections, each one with
+        # its own credentials, that feed the same pipeline (the primary key merges tweets matched by several)
+        shards = min(shards, len(self.filter['track_terms']))
+        self.shards = [StreamShard(number=i, track_terms=self.filter['track_terms'][i::shards],
+                                   credentials=credential_set, filter_name=self.filter['name'])
+                       for i, credential_set in enumerate(shard_credentials(credentials, shards))]
+        if len(self.shards) > 1:
+            for shard in self.shards:
+                logging.info("Shard %d tracks %s", shard.number, shard.track_terms)
+
+        self.work_dir = Path(work_dir) if work_dir is not None else Path(Path(__file__).parent, 'tmp')
+        self.db_name = Path(self.work_dir, 'tweets.sqlite')
         Path(self.db_name).parent.mkdir(parents=True, exist_ok=True)
-        logging.info("Create SQLite file if does not exist at %s", self.db_name)
-        self.database = sqlite3.connect(str(self.db_name), isolation_level=None)
-        logging.info("Create table for Tweets if not exist with query: %s", self.__CREATE_TABLE_TWEET)
-        self.database.execute(self.__CREATE_TABLE_TWEET)
-        self.database.execute(self.__CREATE_TABLE_UNIQUE_TWEET)
-        self.database.execute(self.__CREATE_TABLE_ATHENA_PREFIX)
-        self.database.execute(self.__INSERT_ATHENA_PREFIX, (self.filter['name'], self.creation_date))
-        self.database.close()
-
-    def __recursive_listen(self):
+        self.segments_dir = Path(self.work_dir, 'segments')
+        # another host (and its certificate) stands in for stream.twitter.com, as aux_scripts/mock_stream_server.py
+        self.stream_options = {'verify': stream_verify}
+        if stream_host:
+            logging.info("Connect to %s instead of the Twitter streaming API", stream_host)
+            self.stream_options['host'] = stream_host
+        # a shard reconnects with the capped back off for as long as the outage lasts; max_outage_minutes, if
+        # set, gives up on a shard whose outage lasts longer, and must leave room for several of the longest waits
+        if max_outage_minutes and max_outage_minutes * 60 < 4 * Backoff.RATE_LIMIT_CAP:
+            raise ValueError("max_outage_minutes must be at least {} minutes: four of the longest back offs".format(
+                4 * Backoff.RATE_LIMIT_CAP / 60))
+        self.max_outage_minutes = max_outage_minutes
+        self.slim_storage = slim_storage
+        self.create_table_tweet = self.__CREATE_TABLE_SLIM_TWEET if slim_storage else self.__CREATE_TABLE_TWEET
+        if blob_compression not in ('none', 'zstd'):
+            raise ValueError("Unknown blob compression {}".format(blob_compression))
+        self.blob_compression = blob_compression
+        self.dictionary_samples = dictionary_samples
+        self.dictionary_size = dictionary_size
+        self.compressor = None
+        self.pipeline = None
+        # the periodic export may not write the files of a day while it is exported, uploaded and removed
+        self.export_lock = threading.RLock()
+        if not self.daemon:
+            self.__create_database(self.db_name, self.creation_date)
+
+    def __create_database(self, db_name, creation_date):
+        logging.info("Create SQLite file if does not exist at %s", db_name)
+        database = sqlite3.connect(str(db_name), isolation_level=None)
+        # the daemon opens the database of the current day again when it restarts
+        if database.execute("select 1 from sqlite_master where type = 'table' and name = 'tweet'").fetchone() is None:
+            logging.info("Create table for Tweets if not exist with query: %s", self.create_table_tweet)
+            database.execute(self.create_table_tweet)
+            database.execute(self.__CREATE_TABLE_ATHENA_PREFIX)
+            database.execute(self.__INSERT_ATHENA_PREFIX, (self.filter['name'], creation_date))
+        database.close()
+
+    def __listen(self, shard):
+        # Connect again and again until the time window ends. Each failure is a network error, a stall
+        # (no data, not even keep-alive newlines, for STALL_TIMEOUT seconds) or an HTTP error, and is
+        # followed by the matching back off; a connection that delivered messages starts the back off again.
+        # There is no limit on the attempts: only max_outage_minutes, if set, stops a shard that stays down.
+        backoff = Backoff()
+        failures = 0
+        while not self.pipeline.finished.is_set():
+            received = shard.received
+            shard.connect()
+            logging.info("Authenticate and listen to tweets on shard %d...", shard.number)
+            auth = tweepy.OAuthHandler(consumer_key=shard.consumer_key, consumer_secret=shard.consumer_secret)
+            auth.set_access_token(key=shard.access_token, secret=shard.access_token_secret)
+            my_stream_listener = TwitterListener(pipeline=self.pipeline, shard=shard)
+            my_stream = StreamConnection(auth=auth, listener=my_stream_listener, timeout=self.STALL_TIMEOUT,
+                                         **self.stream_options)
+            try:
+                my_stream.filter(track=shard.track_terms, languages=self.filter['languages'])
+                if self.pipeline.finished.is_set():
+                    break
+                if my_stream_listener.status_code == 420:
+                    reason, error = 'rate_limit', "HTTP 420"
+                elif my_stream_listener.status_code is not None:
+                    reason, error = 'http', "HTTP {}".format(my_stream_listener.status_code)
+                elif my_stream_listener.stalled:
+                    reason, error = 'stall', "Timeout while connecting"
+                else:
+                    reason, error = 'network', "Connection ended"
+            except self.STALL_EXCEPTIONS as e:
+                reason, error = 'stall', repr(e)
+            except Exception as e:
+                reason, error = 'network', repr(e)
+
+            if shard.received > received:
+                backoff.reset()
+                failures = 0
+            failures = failures + 1
+            shard.open_gap(reason)
+            outage = clock.monotonic() - shard.gap['started']
+            if self.max_outage_minutes and outage > self.max_outage_minutes * 60:
+                logging.info("Shard %d could not reconnect for %.0f seconds (%d attempts): TERMINATE",
+                             shard.number, outage, failures)
+                raise StreamError("Shard {} could not reconnect: {}".format(shard.number, error))
+            wait = backoff.next(reason)
+            METRICS.inc('twitter_stream_reconnects_total', reason=reason, **shard.labels)
+            logging.info("Shard %d disconnected (%s): attempt %d to reconnect in %.2f seconds",
+                         shard.number, error, failures, wait)
+            self.pipeline.finished.wait(wait)
+
+    def __listen_to_shard(self, shard):
+        shard.started = clock.monotonic()
         try:
-            logging.info("Authenticate and listen to tweets...")
-            auth = tweepy.OAuthHandler(consumer_key=self.consumer_key, consumer_secret=self.consumer_secret)
-            auth.set_access_token(key=self.access_token, secret=self.access_token_secret)
-            api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
-            my_stream_listener = TwitterListener(database=self.database,
-                                                 start_saving=self.start_saving,
-                                                 end_saving=self.end_saving,
-                                                 end_execution=self.end_execution)
-            my_stream = tweepy.Stream(auth=api.auth, listener=my_stream_listener)
-            my_stream.filter(track=self.filter['track_terms'], languages=self.filter['languages'])
-        except Exception as e:
-            global num_exceptions
-            if num_exceptions > self.MAX_ATTEMPTS_TWITTER_STREAM:
-                logging.info("Exceeded maximum number of exceptions (%d) while listening to tweets: TERMINATE",
-                             self.MAX_ATTEMPTS_TWITTER_STREAM)
-                raise
-            else:
-                num_exceptions = num_exceptions + 1
-                logging.info("Exception number %d while listening to tweets: resume listening.", num_exceptions)
-                logging.info("Exception: %s", repr(e))
-                self.__recursive_listen()
+            self.__listen(shard)
+        finally:
+            shard.stopped = clock.monotonic()
+            logging.info("Shard %d: %d messages (%.1f per second) - %d limit notices - %d tweets not delivered",
+                         shard.number, shard.received, shard.throughput(), shard.limit_notices, shard.undelivered)
+
+    def __open_tweet_database(self, db_name, create=False):
+        # writer threads share the connection; TweetWriter serializes access to it
+        database = sqlite3.connect(str(db_name), isolation_level=None, check_same_thread=False)
+        database.execute("pragma journal_mode=wal")
+        database.execute("pragma synchronous=normal")
+        if create:
+            database.execute(self.create_table_tweet)
+        return database
+
+    def __segment_file(self, number, extension):
+        return Path(self.segments_dir, "twitter_stream_{:04d}.{}".format(number, extension))
+
+    def __open_segment(self, number):
+        segment = self.__segment_file(number, 'sqlite')
+        logging.info("Open segment %s", segment)
+        return self.__open_tweet_database(segment, create=True)
+
+    def __process_segment(self, number):
+        segment = self.__segment_file(number, 'sqlite')
+        json_file = Path(compressed_file_name(self.__segment_file(number, 'json'), self.compression))
+        orc_file = self.__segment_file(number, 'orc')
+        with METRICS.stage('export_segment', filter=self.filter['name']):
+            count = export_tweets(db_name=segment, json_file=json_file, orc_file=orc_file,
+                                  workers=self.export_workers, compression=self.compression,
+                                  compression_workers=self.compression_workers, orc_options=self.orc_options)
+        if count > 0:
+            with METRICS.stage('upload_segment', filter=self.filter['name']):
+                self.uploader.upload_segment(json_file=json_file, orc_file=orc_file,
+                                             filter_name=self.filter['name'], creation_date=self.creation_date)
+            if not self.partition_added:
+                # the day's partition is queryable from the first segment on, not only at the end of the day
+                self.uploader.recreate_athena_table()
+                self.partition_added = True
+        logging.info("Segment %d processed: %d tweets", number, count)
+        json_file.unlink()
+        orc_file.unlink()
+        for suffix in ('', '-wal', '-shm'):
+            Path("{}{}".format(segment, suffix)).unlink(missing_ok=True)
+
+    def __day_directory(self, day):
+        return Path(self.work_dir, 'days', datetime.utcfromtimestamp(day / 1000).strftime("%Y-%m-%d"))
+
+    def __open_day(self, day):
+        day_dir = self.__day_directory(day)
+        day_dir.mkdir(parents=True, exist_ok=True)
+        db_name = Path(day_dir, 'tweets.sqlite')
+        self.__create_database(db_name, day_dir.name)
+        logging.info("Open day %s at %s", day_dir.name, db_name)
+        return TweetWriter(database=self.__open_tweet_database(db_name),
+                           batch_size=self.batch_size,
+                           flush_interval=self.flush_interval,
+                           dedup_cache_size=self.dedup_cache_size,
+                           filter_name=self.filter['name'],
+                           slim=self.slim_storage,
+                           compressor=self.compressor)
+
+    def __process_day(self, day):
+        # a finished day of the daemon: export it, upload it and register its partitions, as the daily
+        # run of twitter_stream_uploader.py does, and then free the disk
+        day_dir = self.__day_directory(day)
+        with self.export_lock, METRICS.stage('process_day', filter=self.filter['name']):
+            if not self.stream_export:
+                self.__export(day_dir, Path(day_dir, 'tweets.sqlite'), datetime.utcfromtimestamp(day / 1000))
+            if self.uploader is None:
+                logging.info("No uploader: day %s stays in %s", day_dir.name, day_dir)
+                return
+            uploader = self.uploader.for_work_dir(day_dir)
+            if uploader.save_to_s3():
+                uploader.recreate_athena_table()
+            shutil.rmtree(day_dir)
+        logging.info("Day %s processed and removed from %s", day_dir.name, day_dir)
+
+    def stop(self):
+        # daemon mode: end the connections and the writer threads (SIGTERM)
+        logging.info("Stop collecting tweets")
+        if self.pipeline is not None:
+            self.pipeline.finished.set()
 
     def listen_to_tweets(self):
-        self.database = sqlite3.connect(str(self.db_name), isolation_level=None)
-        self.__recursive_listen()
-        self.database.close()
-
-    def __gen_dict_extract(self, key, var):
-        if hasattr(var, 'items'):
-            for k, v in var.items():
-                if k == key:
-                    yield v
-                if isinstance(v, dict):
-                    for result in self.__gen_dict_extract(key, v):
-                        yield result
-                elif isinstance(v, list):
-                    for d in v:
-                        for result in self.__gen_dict_extract(key, d):
-                            yield result
+        rotator = None
+        days = None
+        if self.blob_compression == 'zstd':
+            self.compressor = TweetCompressor(samples=self.dictionary_samples, dictionary_size=self.dictionary_size)
+        if self.daemon:
+            first_day = epoch_ms(self.start_saving)
+            days = DayRotator(open_day=self.__open_day,
+                              process_day=self.__process_day,
+                              first_day_ms=first_day,
+                              delay_end_ms=epoch_ms(self.end_execution) - epoch_ms(self.end_saving),
+                              flush_interval=self.flush_interval,
+                              filter_name=self.filter['name'])
+            # days left by a previous run that ended before they did
+            for day_dir in sorted(Path(self.work_dir, 'days').glob('????-??-??')):
+                day = epoch_ms(datetime.strptime(day_dir.name, "%Y-%m-%d"))
+                if day < first_day:
+                    days.hand_over(day)
+        elif self.rotation_minutes or self.rotation_tweets:
+            self.segments_dir.mkdir(parents=True, exist_ok=True)
+            pending = sorted(int(segment.stem.rpartition('_')[2])
+                             for segment in self.segments_dir.glob('twitter_stream_*.sqlite'))
+            rotator = SegmentRotator(open_segment=self.__open_segment,
+                                     process_segment=self.__process_segment,
+                                     rotation_minutes=self.rotation_minutes,
+                                     rotation_tweets=self.rotation_tweets,
+                                     ids_file=Path(self.segments_dir, 'tweet_ids.sqlite'),
+                                     pending=pending)
+            self.database = rotator.open()
+        else:
+            self.database = self.__open_tweet_database(self.db_name)
+        writer = None
+        if days is None:
+            writer = TweetWriter(database=self.database,
+                                 batch_size=self.batch_size,
+                                 flush_interval=self.flush_interval,
+                                 dedup_cache_size=self.dedup_cache_size,
+                                 rotator=rotator,
+                                 filter_name=self.filter['name'],
+                                 slim=self.slim_storage,
+                                 compressor=self.compressor)
+        self.pipeline = TweetPipeline(writer=writer,
+                                      start_saving=self.start_saving,
+                                      end_saving=self.end_saving,
+                                      end_execution=self.end_execution,
+                                      queue_size=self.queue_size,
+                                      num_workers=self.writer_threads,
+                                      filter_name=self.filter['name'],
+                                      slim=self.slim_storage,
+                                      compressor=self.compressor,
+                                      days=days)
+        METRICS.set('twitter_stream_disk_bytes', lambda: directory_size(self.work_dir), filter=self.filter['name'])
+        self.pipeline.start()
+        export_stopped = threading.Event()
+        exporter = None
+        if self.export_interval_minutes and rotator is None:
+            exporter = threading.Thread(target=self.__export_periodically, args=(export_stopped,),
+                                        name="periodic-export", daemon=True)
+            exporter.start()
+        try:
+            # a shard that gives up does not stop the others: its exception is raised once all of them end
+            run_concurrently(*[lambda shard=shard: self.__listen_to_shard(shard) for shard in self.shards])
+        finally:
+            export_stopped.set()
+            if exporter is not None:
+                exporter.join()
+            self.pipeline.stop()
+            if days is not None:
+                days.close()
+            elif rotator is not None:
+                # finalize the last segment: export and upload it before returning
+                rotator.close(writer.database)
+            else:
+                self.database.close()
+
+    def __export_periodically(self, stopped):
+        # the final prepare_database only has the tweets since the last of these exports left
+        while not stopped.wait(self.export_interval_minutes * 60):
+            try:
+                self.export_new_tweets(settle_ms=self.export_settle_seconds * 1000, merge_orc=False)
+            except Exception:
+                logging.exception("Periodic export failed: the next export starts again from the watermark")
+
+    def export_new_tweets(self, settle_ms=0, merge_orc=True):
+        if self.daemon:
+            for day in self.pipeline.days.open_days():
+                day_dir = self.__day_directory(day)
+                with self.export_lock:
+                    if not Path(day_dir, 'tweets.sqlite').exists():
+                        # closed and processed since the list was taken
+                        continue
+                    self.__export(day_dir, Path(day_dir, 'tweets.sqlite'), datetime.utcfromtimestamp(day / 1000),
+                                  settle_ms, merge_orc)
+        else:
+            self.__export(self.work_dir, self.db_name, self.start_saving, settle_ms, merge_orc)
+
+    def __export(self, work_dir, db_name, day_start, settle_ms=0, merge_orc=True):
+        json_file = Path(compressed_file_name(Path(work_dir, 'twitter_stream.json'), self.compression))
+        orc_file = Path(work_dir, 'twitter_stream.orc')
+        with self.export_lock, METRICS.stage('export', filter=self.filter['name']):
+            if self.hourly_partitions:
+                logging.info("Fill one JSON file %s and one ORC file %s per hour in %s with tweets from %s sorted "
+                             "by ID", json_file.name, orc_file.name, Path(work_dir, 'hours'), db_name)
+                count = export_new_tweets_by_hour(db_name=db_name, work_dir=work_dir,
+                                                  day_start_ms=epoch_ms(day_start),
+                                                  json_name=json_file.name, orc_name=orc_file.name,
+                                                  workers=self.export_workers, compression=self.compression,
+                                                  compression_workers=self.compression_workers,
+                                                  settle_ms=settle_ms, orc_options=self.orc_options,
+                                                  merge_orc=merge_orc)
+            else:
+                logging.info("Fill JSON file %s and ORC file %s with tweets from %s sorted by ID",
+                             json_file, orc_file, db_name)
+                count = export_new_tweets(db_name=db_name, json_file=json_file, orc_file=orc_file,
+                                          workers=self.export_workers, compression=self.compression,
+                                          compression_workers=self.compression_workers, settle_ms=settle_ms,
+                                          orc_options=self.orc_options, merge_orc=merge_orc)
+        logging.info("%d tweets written", count)
 
     def prepare_database(self):
         logging.info("BEGIN: prepare database for conversion")
+        if self.rotation_minutes or self.rotation_tweets:
+            logging.info("Segments were exported and uploaded while collecting: nothing to do")
+            logging.info("END: prepare database for conversion")
+            return
+        if self.daemon:
+            logging.info("Days are exported and uploaded as they end: nothing to do")
+            logging.info("END: prepare database for conversion")
+            return
+        if self.stream_export:
+            logging.info("The uploader streams the database to S3: nothing to export")
+            logging.info("END: prepare database for conversion")
+            return
+
+        # continues from the watermark of the periodic exports (or of a run that crashed)
+        self.export_new_tweets()
 
-        logging.info("Open database again: %s", self.db_name)
-        self.database = sqlite3.connect(str(self.db_name), isolation_level=None)
-        self.database.row_factory = sqlite3.Row
-
-        self.database.execute(self.__INSERT_UNIQUE_TWEET)
-
-        json_file = Path(Path(__file__).parent, 'tmp', 'twitter_stream.json')
-        logging.info("Create JSON file %s", json_file)
-        with open(json_file, 'w') as json_writer:
-            logging.info("Execute query to eliminate duplicated tweets and sort by ID: %s",
-                         self.__SELECT_UNIQUE_TWEETS)
-            cursor_records = self.database.cursor()
-            cursor_records.execute(self.__SELECT_UNIQUE_TWEETS)
-            logging.info("Fill JSON file with tweets")
-            for record in cursor_records:
-                # standardize all dates to PrestoDB/Athena format
-                json_line = record['tweet_json']
-                tweet_json = json.loads(json_line)
-                for created_at in self.__gen_dict_extract('created_at', tweet_json):
-                    json_line = json_line.replace(created_at,
-                                                  datetime.strftime(datetime.strptime(created_at,
-                                                                                      '%a %b %d %H:%M:%S +0000 %Y'),
-                                                                    '%Y-%m-%d %H:%M:%S'),
-                                                  1)
-                json_writer.write("{}\n".format(json_line.strip("\r\n")))
-
-        self.database.close()
         logging.info("END: prepare database for conversion")
 
 
+def create_twitter_stream(config, twitter_filter, credentials, work_dir=None):
+    uploader = None
+    if config['twitter_stream'].get('rotation_minutes') or config['twitter_stream'].get('rotation_tweets') or \
+            config['twitter_stream'].get('daemon'):
+        uploader = create_uploader(config, work_dir)
+    return TwitterStream(twitter_filter=twitter_filter,
+                         credentials=credentials,
+                         batch_size=config['twitter_stream'].get('batch_size', TwitterStream.DEFAULT_BATCH_SIZE),
+                         flush_interval=config['twitter_stream'].get('flush_interval',
+                                                                     TwitterStream.DEFAULT_FLUSH_INTERVAL),
+                         queue_size=config['twitter_stream'].get('queue_size', TwitterStream.DEFAULT_QUEUE_SIZE),
+                         writer_threads=config['twitter_stream'].get('writer_threads',
+                                                                     TwitterStream.DEFAULT_WRITER_THREADS),
+                         dedup_cache_size=config['twitter_stream'].get('dedup_cache_size',
+                                                                       TwitterStream.DEFAULT_DEDUP_CACHE_SIZE),
+                         export_workers=config['twitter_stream'].get('export_workers',
+                                                                     TwitterStream.DEFAULT_EXPORT_WORKERS),
+                         compression=config['twitter_stream'].get('compression',
+                                                                  TwitterStream.DEFAULT_COMPRESSION),
+                         compression_workers=config['twitter_stream'].get('compression_workers'),
+                         rotation_minutes=config['twitter_stream'].get('rotation_minutes'),
+                         rotation_tweets=config['twitter_stream'].get('rotation_tweets'),
+                         uploader=uploader,
+                         work_dir=work_dir,
+                         shards=config['twitter_stream'].get('stream_shards', TwitterStream.DEFAULT_STREAM_SHARDS),
+                         stream_host=config['twitter_stream'].get('stream_host'),
+                         stream_verify=config['twitter_stream'].get('stream_verify', True),
+                         slim_storage=config['twitter_stream'].get('slim_storage', False),
+                         blob_compression=config['twitter_stream'].get('blob_compression',
+                                                                       TwitterStream.DEFAULT_BLOB_COMPRESSION),
+                         dictionary_samples=config['twitter_stream'].get('dictionary_samples',
+                                                                         TweetCompressor.DEFAULT_SAMPLES),
+                         dictionary_size=config['twitter_stream'].get('dictionary_size',
+                                                                      TweetCompressor.DEFAULT_DICTIONARY_SIZE),
+                         export_interval_minutes=config['twitter_stream'].get('export_interval_minutes'),
+                         export_settle_seconds=config['twitter_stream'].get(
+                             'export_settle_seconds', TwitterStream.DEFAULT_EXPORT_SETTLE_SECONDS),
+                         hourly_partitions=config['twitter_stream'].get('hourly_partitions', False),
+                         orc_options=orc_options(config),
+                         daemon=config['twitter_stream'].get('daemon', False),
+                         stream_export=config['twitter_stream'].get('stream_export', False),
+                         max_outage_minutes=config['twitter_stream'].get('max_outage_minutes'))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='S3 Bucket with configuration', required=True)
     args = parser.parse_args()
 
     config = read_dict_from_s3_url(url=args.config)
+    set_s3_endpoint(config['aws'].get('s3_endpoint_url'))
     logger = AthenaLogger(app_name="twitter_stream",
                           s3_bucket=config['aws']['s3-admin'],
                           athena_db=config['aws']['athena-admin'])
+    reporter = None
     try:
-        twitter_stream = TwitterStream(twitter_filter=config['twitter_filter'],
-                                       credentials=config['twitter_credentials'])
-        twitter_stream.listen_to_tweets()
-        twitter_stream.prepare_database()
+        configure_profiler(config, Path(Path(__file__).parent, 'tmp', 'profile'))
+        if config['twitter_stream'].get('metrics_port'):
+            start_metrics_server(config['twitter_stream']['metrics_port'])
+        metrics_interval = config['twitter_stream'].get('metrics_interval', MetricsReporter.DEFAULT_INTERVAL)
+        if metrics_interval:
+            reporter = MetricsReporter(metrics_interval)
+            reporter.start()
+        twitter_streams = [create_twitter_stream(config, twitter_filter, credentials, work_dir)
+                           for twitter_filter, credentials, work_dir in twitter_filters(config)]
+        if config['twitter_stream'].get('daemon'):
+            # the filters are saved once: the daemon only uploads the days of tweets after that
+            filters = [TwitterFilter(twitter_filter=twitter_filter,
+                                     s3_bucket=config['aws']['s3-data'],
+                                     athena_db=config['aws']['athena-data'])
+                       for twitter_filter, credentials, work_dir in twitter_filters(config)]
+            run_concurrently(*[twitter_filter.save_to_s3 for twitter_filter in filters])
+            filters[0].recreate_athena_table()
+            # run until stopped (systemctl stop, kill): the open days stay on disk for the next start
+            signal.signal(signal.SIGTERM, lambda signum, frame: [twitter_stream.stop()
+                                                                 for twitter_stream in twitter_streams])
+        # each filter has its own connection, credentials and database: listen to all of them at the same
+        # time and then export all of them at the same time
+        run_concurrently(*[twitter_stream.listen_to_tweets for twitter_stream in twitter_streams])
+        run_concurrently(*[twitter_stream.prepare_database for twitter_stream in twitter_streams])
     finally:
+        if reporter is not None:
+            reporter.stop()
         logger.save_to_s3()
 
 
@@ -0,0 +1,750 @@
+from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from pathlib import Path
+import bz2
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from twitter_stream_metrics import METRICS
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+ATHENA_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Every created_at in a tweet (its own, the user's, the retweeted and the quoted ones) is a string value
+# of a "created_at" key. JSON escapes quotes inside strings, so the pattern cannot match tweet text.
+CREATED_AT = re.compile(r'("created_at":\s*")([^"]*)"')
+
+DATE_CACHE_SIZE = 2 ** 16
+
+# Twitter's snowflake ids are milliseconds since this epoch shifted 22 bits to the left
+TWITTER_EPOCH_MS = 1288834974657
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def athena_date(twitter_date):
+    return datetime.strftime(datetime.strptime(twitter_date, TWITTER_DATE_FORMAT), ATHENA_DATE_FORMAT)
+
+
+def __replace_created_at(match):
+    return match.group(1) + athena_date(match.group(2)) + '"'
+
+
+def normalize_tweet(json_line):
+    # standardize all dates to PrestoDB/Athena format in a single pass over the string
+    return CREATED_AT.sub(__replace_created_at, json_line.strip("\r\n"))
+
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def compress_tweet(raw_data):
+    # the whole payload kept next to the slim projection, for twitter_stream_raw
+    return zlib.compress(raw_data.encode('utf-8'), 6)
+
+
+def decompress_tweet(value, decompressor=None):
+    # a stored tweet is text, a zlib payload (slim storage) or a zstd frame (blob compression)
+    if isinstance(value, str):
+        return value
+    if value[:4] == ZSTD_MAGIC:
+        return decompressor.decompress(value).decode('utf-8')
+    return zlib.decompress(value).decode('utf-8')
+
+
+class TweetCompressor:
+    # Compresses tweets with a zstd dictionary trained on the first tweets: every tweet repeats the same keys,
+    # sources and user objects, which a dictionary captures and compressing each tweet alone cannot.
+    # Tweets that arrive before the dictionary is trained are stored as text.
+    DEFAULT_SAMPLES = 2000
+    DEFAULT_DICTIONARY_SIZE = 112640
+    DEFAULT_LEVEL = 3
+
+    def __init__(self, samples=DEFAULT_SAMPLES, dictionary_size=DEFAULT_DICTIONARY_SIZE, level=DEFAULT_LEVEL):
+        if zstandard is None:
+            raise ValueError("Blob compression zstd requires the zstandard package")
+        self.samples_needed = samples
+        self.samples = []
+        self.dictionary_size = dictionary_size
+        self.level = level
+        self.dictionary = None
+        self.lock = threading.Lock()
+        # zstandard compressors cannot be shared by threads: each writer thread gets its own
+        self.local = threading.local()
+
+    def compress(self, text):
+        data = text.encode('utf-8')
+        if self.dictionary is None:
+            with self.lock:
+                if self.dictionary is None:
+                    if self.samples is not None:
+                        self.samples.append(data)
+                        if len(self.samples) >= self.samples_needed:
+                            self.__train()
+                    return text
+        compressor = getattr(self.local, 'compressor', None)
+        if compressor is None:
+            compressor = self.local.compressor = zstandard.ZstdCompressor(dict_data=self.dictionary,
+                                                                         level=self.level)
+        return compressor.compress(data)
+
+    def __train(self):
+        started = time.perf_counter()
+        try:
+            dictionary = zstandard.train_dictionary(self.dictionary_size, self.samples, level=self.level)
+        except zstandard.ZstdError:
+            logging.exception("Could not train a compression dictionary: keep storing tweets as text")
+            self.samples = None
+            return
+        dictionary.precompute_compress(level=self.level)
+        logging.info("Trained a compression dictionary of %d bytes on %d tweets in %.2f seconds",
+                     len(dictionary.as_bytes()), len(self.samples), time.perf_counter() - started)
+        self.samples = None
+        self.dictionary = dictionary
+
+    def use_dictionary(self, data):
+        # the dictionary of a day database that is opened again (restart, daemon): no need to train another
+        with self.lock:
+            if self.dictionary is None:
+                dictionary = zstandard.ZstdCompressionDict(data)
+                dictionary.precompute_compress(level=self.level)
+                self.samples = None
+                self.dictionary = dictionary
+                logging.info("Use the compression dictionary stored in the database")
+
+
+class TweetDecompressor:
+    # Every zstd frame names the dictionary it was compressed with: a database written by several runs may
+    # hold tweets compressed with more than one
+    def __init__(self, dictionaries):
+        self.decompressors = {}
+        for data in dictionaries:
+            dictionary = zstandard.ZstdCompressionDict(data)
+            self.decompressors[dictionary.dict_id()] = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+    def decompress(self, value):
+        return self.decompressors[zstandard.get_frame_parameters(value).dict_id].decompress(value)
+
+
+def stored_dictionaries(database):
+    # the dictionaries saved by TweetWriter in the same file as the tweets they compressed
+    if not database.execute("select 1 from sqlite_master where type = 'table' and name = 'compression_dictionary'"
+                            ).fetchone():
+        return []
+    return [record[0] for record in database.execute("select dictionary from compression_dictionary")]
+
+
+def tweet_decompressor(database):
+    dictionaries = stored_dictionaries(database)
+    if not dictionaries:
+        return None
+    if zstandard is None:
+        raise ValueError("Tweets compressed with zstd require the zstandard package")
+    return TweetDecompressor(dictionaries)
+
+
+# a low level, as for TweetCompressor, so that zstd does not become the slowest step of the export
+ZSTD_LEVEL = 3
+
+
+def __zstd_compress(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+# Codecs that Athena reads for JSON tables. Each block is compressed as an independent stream (bz2 stream,
+# gzip member or zstd frame); concatenated streams are still one valid file for Athena and the usual tools.
+COMPRESSION_CODECS = {
+    'none': ('', None),
+    'bz2': ('.bz2', lambda data: bz2.compress(data, 9)),
+    'gzip': ('.gz', lambda data: gzip.compress(data, 9, mtime=0)),
+    'zstd': ('.zst', __zstd_compress)
+}
+
+
+def compressed_file_name(file_name, compression):
+    return "{}{}".format(file_name, COMPRESSION_CODECS[compression][0])
+
+
+class CompressedWriter:
+    # Text file writer that compresses blocks in a thread pool (bz2, zlib and zstd release the GIL)
+    # and writes them in order, keeping at most a few blocks per thread in memory
+    DEFAULT_BLOCK_SIZE = 9 * 10 ** 6
+
+    def __init__(self, file_name, compression, workers=None, block_size=DEFAULT_BLOCK_SIZE):
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("Compression zstd requires the zstandard package")
+        self.compress = COMPRESSION_CODECS[compression][1]
+        # a file name, or an object with write and close (a multipart upload to S3)
+        self.file = file_name if hasattr(file_name, 'write') else open(file_name, 'wb')
+        self.workers = workers or os.cpu_count()
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.compress is not None else None
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if self.buffered >= self.block_size:
+            self.__submit()
+
+    def __submit(self):
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.executor is None:
+            self.file.write(block)
+            return
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) > 2 * self.workers:
+            self.file.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffered:
+            self.__submit()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_tweets(json_lines, json_writer, orc_writer=None):
+    count = 0
+    for json_line in json_lines:
+        json_line = normalize_tweet(json_line)
+        json_writer.write(json_line)
+        json_writer.write("\n")
+        if orc_writer is not None:
+            orc_writer.write(json_line)
+        count = count + 1
+    return count
+
+
+def write_slim_tweets(records, json_writer, orc_writer=None, decompressor=None):
+    # slim storage: the JSON file gets the whole payload and the ORC file only the projection
+    count = 0
+    for tweet_json, tweet_raw in records:
+        tweet_json = normalize_tweet(decompress_tweet(tweet_json, decompressor))
+        if tweet_raw is None:
+            raw_line = tweet_json
+        else:
+            raw_line = normalize_tweet(decompress_tweet(tweet_raw, decompressor))
+        json_writer.write(raw_line)
+        json_writer.write("\n")
+        if orc_writer is not None:
+            orc_writer.write(tweet_json)
+        count = count + 1
+    return count
+
+
+__SELECT_TWEETS = """
+select {columns}
+from {table}
+where {condition}
+order by tweet_id
+"""
+
+__SELECT_BOUNDARY = """
+select tweet_id
+from {table}
+where {condition}
+order by tweet_id
+limit 1 offset ?
+"""
+
+
+def range_condition(lower, upper):
+    # only bounded sides go into the query so that SQLite can seek on the primary key
+    conditions = []
+    parameters = []
+    if lower is not None:
+        conditions.append("tweet_id >= ?")
+        parameters.append(lower)
+    if upper is not None:
+        conditions.append("tweet_id < ?")
+        parameters.append(upper)
+    return " and ".join(conditions) or "1 = 1", parameters
+
+
+def __export_range(db_name, table, lower, upper, json_file, orc_file=None, compression='none',
+                   compression_workers=None, orc_options=None):
+    database = sqlite3.connect(str(db_name), isolation_level=None)
+    orc_writer = None
+    try:
+        condition, parameters = range_condition(lower, upper)
+        slim = 'tweet_raw' in [column[1] for column in database.execute("pragma table_info({})".format(table))]
+        query = __SELECT_TWEETS.format(columns="tweet_json, tweet_raw" if slim else "tweet_json", table=table,
+                                       condition=condition)
+        decompressor = tweet_decompressor(database)
+        cursor_records = database.execute(query, parameters)
+        if orc_file is not None:
+            orc_writer = OrcTweetWriter(orc_file, options=orc_options)
+        with CompressedWriter(json_file, compression, compression_workers) as json_writer:
+            if slim:
+                return write_slim_tweets(cursor_records, json_writer, orc_writer, decompressor)
+            if decompressor is not None:
+                return write_tweets((decompress_tweet(record[0], decompressor) for record in cursor_records),
+                                    json_writer, orc_writer)
+            return write_tweets((record[0] for record in cursor_records), json_writer, orc_writer)
+    finally:
+        if orc_writer is not None:
+            orc_writer.close()
+        database.close()
+
+
+def migrate_tweet_table(database, table='tweet'):
+    # Day files from older versions keep tweet_id as a string primary key, that is, a separate index that
+    # the ordered export has to follow: copy the table into one whose rowid is tweet_id
+    columns = [(column[1], column[2]) for column in database.execute("pragma table_info({})".format(table))]
+    if not columns or dict(columns).get('tweet_id', '').lower() == 'integer':
+        return False
+    logging.info("Migrate table %s to an integer tweet_id primary key", table)
+    definitions = ["tweet_id integer primary key"] + ["{} {}".format(name, column_type)
+                                                      for name, column_type in columns if name != 'tweet_id']
+    names = [name for name, _ in columns]
+    database.execute("begin")
+    database.execute("alter table {table} rename to {table}_migrated".format(table=table))
+    database.execute("create table {table} ({definitions})".format(table=table, definitions=", ".join(definitions)))
+    database.execute("insert or ignore into {table} ({names}) select {values} from {table}_migrated "
+                     "order by cast(tweet_id as integer)".format(
+                         table=table, names=", ".join(names),
+                         values=", ".join("cast(tweet_id as integer)" if name == 'tweet_id' else name
+                                          for name in names)))
+    database.execute("drop table {table}_migrated".format(table=table))
+    database.execute("commit")
+    # give the pages of the old table and its index back to the file system
+    database.execute("vacuum")
+    return True
+
+
+def split_ranges(database, table, parts, lower=None, upper=None):
+    # Boundaries that split the table (or its rows in [lower, upper)) in parts of about the same number
+    # of rows. Each range is [lower, upper), None meaning unbounded.
+    condition, parameters = range_condition(lower, upper)
+    total = database.execute("select count(*) from {table} where {condition}".format(table=table,
+                                                                                    condition=condition),
+                             parameters).fetchone()[0]
+    boundaries = []
+    for i in range(1, parts):
+        row = database.execute(__SELECT_BOUNDARY.format(table=table, condition=condition),
+                               parameters + [total * i // parts]).fetchone()
+        if row is not None and (not boundaries or row[0] != boundaries[-1]):
+            boundaries.append(row[0])
+    lower_bounds = [lower] + boundaries
+    upper_bounds = boundaries + [upper]
+    return list(zip(lower_bounds, upper_bounds))
+
+
+def export_tweets(db_name, json_file, orc_file=None, workers=1, table='tweet', compression='none',
+                  compression_workers=None, lower=None, upper=None, orc_options=None):
+    # Write every tweet (or those with lower <= tweet_id < upper) ordered by tweet_id as one normalized JSON
+    # line (and as one ORC row if orc_file is given). With more than one worker, the table is split in key
+    # ranges exported by a process pool and the parts are concatenated in key order, so the uncompressed
+    # output is byte-identical to the serial export. Compressed parts are concatenated streams, which
+    # decompress to the same bytes.
+    if workers <= 1:
+        return __export_range(db_name, table, lower, upper, json_file, orc_file, compression,
+                              compression_workers, orc_options)
+
+    database = sqlite3.connect(str(db_name), isolation_level=None)
+    try:
+        ranges = split_ranges(database, table, workers, lower, upper)
+    finally:
+        database.close()
+    logging.info("Export %d key ranges with %d processes", len(ranges), workers)
+
+    part_files = [Path("{}.part{}".format(json_file, i)) for i in range(len(ranges))]
+    orc_part_files = [None] * len(ranges)
+    if orc_file is not None:
+        orc_part_files = [Path("{}.part{}".format(orc_file, i)) for i in range(len(ranges))]
+    try:
+        with METRICS.stage('export_ranges'), ProcessPoolExecutor(max_workers=workers) as executor:
+            # the export processes already use the cores: compress each part in its own process
+            futures = [executor.submit(__export_range, db_name, table, lower, upper, part_file, orc_part_file,
+                                       compression, 1, orc_options)
+                       for (lower, upper), part_file, orc_part_file in zip(ranges, part_files, orc_part_files)]
+            count = sum(future.result() for future in futures)
+        with METRICS.stage('concatenate_json'), open(json_file, 'wb') as json_writer:
+            for part_file in part_files:
+                with open(part_file, 'rb') as part_reader:
+                    shutil.copyfileobj(part_reader, json_writer, 2 ** 20)
+        if orc_file is not None:
+            with METRICS.stage('merge_orc'):
+                orc_writer = OrcTweetWriter(orc_file, options=orc_options)
+                for orc_part_file in orc_part_files:
+                    orc_writer.append_orc(orc_part_file)
+                orc_writer.close()
+    finally:
+        for part_file in part_files + orc_part_files:
+            if part_file is not None and part_file.exists():
+                part_file.unlink()
+    return count
+
+
+__CREATE_TABLE_EXPORT_STATE = """
+create table if not exists export_state
+    (json_file string,
+    watermark integer,
+    tweets integer,
+    json_bytes integer,
+    orc_parts integer)
+"""
+
+__UPDATE_EXPORT_STATE = """
+insert into export_state
+(json_file, watermark, tweets, json_bytes, orc_parts)
+values (?, ?, ?, ?, ?)
+"""
+
+
+def orc_part_file(orc_file, number):
+    return Path("{}.parts".format(orc_file), "{:05d}.orc".format(number))
+
+
+def orc_rows(orc_file):
+    # read from the footer: the file is not decoded
+    import pyarrow.orc
+    return pyarrow.orc.ORCFile(str(orc_file)).nrows if Path(orc_file).exists() else 0
+
+
+def __set_orc_parts(db_name, json_file, orc_parts):
+    database = sqlite3.connect(str(db_name), isolation_level=None)
+    try:
+        database.execute("update export_state set orc_parts = ? where json_file = ?", (orc_parts, str(json_file)))
+    finally:
+        database.close()
+
+
+def __merge_orc_parts(db_name, json_file, orc_file, orc_parts, orc_options=None):
+    # orc_file (if any) and the parts make up the new orc_file, written aside and then moved over it. The
+    # state then records that no part is left and the parts are removed: a day is not kept twice on disk.
+    merging_file = Path("{}.merging".format(orc_file))
+    orc_writer = OrcTweetWriter(merging_file, options=orc_options)
+    if Path(orc_file).exists():
+        orc_writer.append_orc(orc_file)
+    for i in range(orc_parts):
+        orc_writer.append_orc(orc_part_file(orc_file, i))
+    orc_writer.close()
+    os.replace(merging_file, orc_file)
+    __set_orc_parts(db_name, json_file, 0)
+    shutil.rmtree("{}.parts".format(orc_file), ignore_errors=True)
+
+
+def __valid_export_state(database, table, state, json_file, orc_file, lower):
+    # The output matches the state unless the files were removed or the settings changed, or tweets older
+    # than the watermark arrived after it was set (the count no longer matches): then start from scratch
+    if state is None:
+        return False
+    state_json_file, watermark, tweets, json_bytes, orc_parts = state
+    if state_json_file != str(json_file) or not Path(json_file).exists() or Path(json_file).stat().st_size < json_bytes:
+        logging.info("Export state does not match %s: export every tweet again", json_file)
+        return False
+    if orc_file is not None:
+        # orc_file holds the tweets of the parts merged so far, or all of them when a merge ended before the
+        # state was updated
+        parts = [orc_part_file(orc_file, i) for i in range(orc_parts)]
+        merged = orc_rows(orc_file)
+        if not all(part.exists() for part in parts) or \
+                merged != tweets and merged + sum(orc_rows(part) for part in parts) != tweets:
+            logging.info("ORC file %s or its parts are missing tweets: export every tweet again", orc_file)
+            return False
+    condition, parameters = range_condition(lower, watermark + 1)
+    count = database.execute("select count(*) from {table} where {condition}".format(table=table,
+                                                                                      condition=condition),
+                             parameters).fetchone()[0]
+    if count != tweets:
+        logging.warning("%d tweets arrived below the watermark %d after it was set: export every tweet again",
+                        count - tweets, watermark)
+        return False
+    return True
+
+
+def export_new_tweets(db_name, json_file, orc_file=None, workers=1, table='tweet', compression='none',
+                      compression_workers=None, settle_ms=0, rebuild=False, lower=None, upper=None,
+                      orc_options=None, merge_orc=True):
+    # Incremental export: the day database keeps in export_state the watermark (the highest tweet_id already
+    # in json_file and in the ORC parts), so a run only normalizes the tweets after it, appends them to
+    # json_file as new compressed streams and adds one ORC part; the parts are then merged into orc_file and
+    # removed, unless merge_orc is False: the periodic exports leave that to the final one, as every merge
+    # rewrites the whole day. While collecting, settle_ms keeps the most recent tweets for the next run: the
+    # writer threads and shards do not commit in strict id order. With lower and upper, only tweets with
+    # lower <= tweet_id < upper go into json_file, which has its own watermark. Returns the number of tweets
+    # in json_file.
+    database = sqlite3.connect(str(db_name), isolation_level=None)
+    try:
+        database.execute(__CREATE_TABLE_EXPORT_STATE)
+        state = database.execute("select json_file, watermark, tweets, json_bytes, orc_parts "
+                                 "from export_state where json_file = ?", (str(json_file),)).fetchone()
+        if rebuild or not __valid_export_state(database, table, state, json_file, orc_file, lower):
+            state = (str(json_file), None, 0, 0, 0)
+            if orc_file is not None:
+                shutil.rmtree("{}.parts".format(orc_file), ignore_errors=True)
+                Path(orc_file).unlink(missing_ok=True)
+        _, watermark, tweets, json_bytes, orc_parts = state
+        max_id = database.execute("select max(tweet_id) from {table}".format(table=table)).fetchone()[0]
+    finally:
+        database.close()
+    if orc_file is not None and orc_parts > 0 and orc_rows(orc_file) == tweets:
+        # merged before a crash, but the parts were not removed
+        __set_orc_parts(db_name, json_file, 0)
+        shutil.rmtree("{}.parts".format(orc_file), ignore_errors=True)
+        orc_parts = 0
+
+    # an increment appended before a crash, but not recorded, is dropped
+    with open(json_file, 'ab') as json_writer:
+        json_writer.truncate(json_bytes)
+    if watermark is not None:
+        lower = watermark + 1
+    # snowflake ids start with the creation time in milliseconds, 22 bits to the left
+    if max_id is not None:
+        upper = max_id + 1 - (settle_ms << 22) if upper is None else min(upper, max_id + 1 - (settle_ms << 22))
+    count = 0
+    if max_id is None or (lower is not None and upper <= lower):
+        logging.info("No new tweets to export after the watermark %s", watermark)
+    else:
+        increment_file = Path("{}.increment".format(json_file))
+        increment_orc_file = None
+        if orc_file is not None:
+            increment_orc_file = orc_part_file(orc_file, orc_parts)
+            increment_orc_file.parent.mkdir(parents=True, exist_ok=True)
+        logging.info("Export tweets from %s to %s (watermark %s)", lower, upper, watermark)
+        count = export_tweets(db_name=db_name, json_file=increment_file, orc_file=increment_orc_file, workers=workers,
+                              table=table, compression=compression, compression_workers=compression_workers,
+                              lower=lower, upper=upper, orc_options=orc_options)
+        with METRICS.stage('append_json'), open(json_file, 'ab') as json_writer, \
+                open(increment_file, 'rb') as increment_reader:
+            shutil.copyfileobj(increment_reader, json_writer, 2 ** 20)
+            json_writer.flush()
+            os.fsync(json_writer.fileno())
+            json_bytes = json_writer.tell()
+        increment_file.unlink()
+        if increment_orc_file is not None:
+            if count > 0:
+                orc_parts = orc_parts + 1
+            else:
+                increment_orc_file.unlink()
+
+        database = sqlite3.connect(str(db_name), isolation_level=None)
+        try:
+            database.execute("begin")
+            database.execute("delete from export_state where json_file = ?", (str(json_file),))
+            database.execute(__UPDATE_EXPORT_STATE, (str(json_file), upper - 1, tweets + count, json_bytes, orc_parts))
+            database.execute("commit")
+        finally:
+            database.close()
+        logging.info("%d new tweets exported: %d in %s", count, tweets + count, json_file)
+
+    if orc_file is not None and merge_orc and (orc_parts > 0 or not Path(orc_file).exists()):
+        with METRICS.stage('merge_orc_parts'):
+            __merge_orc_parts(db_name, json_file, orc_file, orc_parts, orc_options)
+    return tweets + count
+
+
+def tweet_id_from_ms(timestamp_ms):
+    return (timestamp_ms - TWITTER_EPOCH_MS) << 22
+
+
+def hour_directory(work_dir, hour):
+    return Path(work_dir, 'hours', '{:02d}'.format(hour))
+
+
+def export_new_tweets_by_hour(db_name, work_dir, day_start_ms, json_name, orc_name, **kwargs):
+    # One JSON and one ORC file per UTC hour of created_at, in hours/HH of work_dir. The table is ordered by
+    # tweet_id and snowflake ids start with the creation time, so each hour is a range of ids.
+    total = 0
+    for hour in range(24):
+        directory = hour_directory(work_dir, hour)
+        directory.mkdir(parents=True, exist_ok=True)
+        total = total + export_new_tweets(db_name=db_name, json_file=Path(directory, json_name),
+                                          orc_file=Path(directory, orc_name),
+                                          lower=tweet_id_from_ms(day_start_ms + hour * 3600000),
+                                          upper=tweet_id_from_ms(day_start_ms + (hour + 1) * 3600000), **kwargs)
+    return total
+
+
+def parse_athena_structure(structure):
+    # Turn an Athena/Hive column list such as STRUCTURE_TWEET_ATHENA into [(name, type)], where type is
+    # either a primitive type name, ('array', type) or ('struct', [(name, type)])
+    tokens = re.findall(r'[A-Za-z_][A-Za-z0-9_]*|[<>:,]', structure)
+    position = 0
+
+    def next_token():
+        nonlocal position
+        position = position + 1
+        return tokens[position - 1]
+
+    def parse_type():
+        name = next_token().lower()
+        if name == 'array':
+            next_token()
+            element = parse_type()
+            next_token()
+            return 'array', element
+        if name == 'struct':
+            next_token()
+            fields = []
+            while True:
+                field_name = next_token()
+                next_token()
+                fields.append((field_name, parse_type()))
+                if next_token() == '>':
+                    return 'struct', fields
+        return name
+
+    columns = []
+    while position < len(tokens):
+        column_name = next_token()
+        columns.append((column_name, parse_type()))
+        if position < len(tokens):
+            next_token()
+    return columns
+
+
+def arrow_type(athena_type):
+    import pyarrow
+    if isinstance(athena_type, tuple):
+        kind, inner = athena_type
+        if kind == 'array':
+            return pyarrow.list_(arrow_type(inner))
+        return pyarrow.struct([(name, arrow_type(field_type)) for name, field_type in inner])
+    return {
+        'boolean': pyarrow.bool_(),
+        'smallint': pyarrow.int16(),
+        'int': pyarrow.int32(),
+        'bigint': pyarrow.int64(),
+        'float': pyarrow.float32(),
+        'double': pyarrow.float64(),
+        'string': pyarrow.string(),
+        'timestamp': pyarrow.timestamp('ms')
+    }[athena_type]
+
+
+def __projection(athena_type):
+    # None keeps a value as it is, [spec] applies spec to every element and {name: spec} keeps only those keys
+    if isinstance(athena_type, tuple):
+        kind, inner = athena_type
+        if kind == 'array':
+            return [__projection(inner)]
+        return {name: __projection(field_type) for name, field_type in inner}
+    return None
+
+
+def __project(value, spec):
+    if spec is None or value is None:
+        return value
+    if isinstance(spec, list):
+        return [__project(item, spec[0]) for item in value] if isinstance(value, list) else value
+    if isinstance(value, dict):
+        return {key: __project(item, spec[key]) for key, item in value.items() if key in spec}
+    return value
+
+
+@lru_cache(maxsize=1)
+def tweet_projection():
+    from twitter_stream_uploader import STRUCTURE_TWEET_ATHENA
+    return __projection(('struct', parse_athena_structure(STRUCTURE_TWEET_ATHENA)))
+
+
+def slim_tweet(raw_data):
+    # keep only what the ORC schema reads: the fields of STRUCTURE_TWEET_ATHENA, in the order they came
+    return json.dumps(__project(json.loads(raw_data), tweet_projection()), ensure_ascii=False,
+                      separators=(',', ':'))
+
+
+def tweet_schema():
+    import pyarrow
+    from twitter_stream_uploader import STRUCTURE_TWEET_ATHENA
+    return pyarrow.schema([(name, arrow_type(column_type))
+                           for name, column_type in parse_athena_structure(STRUCTURE_TWEET_ATHENA)])
+
+
+def orc_column_ids(schema, names):
+    # ORC numbers the columns of the type tree in pre-order (the root struct is 0): bloom filters are set by
+    # these numbers, and nested fields are named with dots (user.id)
+    import pyarrow
+    ids = {}
+
+    def number(name, data_type, next_id):
+        ids[name] = next_id
+        next_id = next_id + 1
+        if pyarrow.types.is_struct(data_type):
+            for field in data_type:
+                next_id = number("{}.{}".format(name, field.name) if name else field.name, field.type, next_id)
+        elif pyarrow.types.is_list(data_type):
+            next_id = number("{}._elem".format(name), data_type.value_type, next_id)
+        return next_id
+
+    number('', pyarrow.struct(list(schema)), 0)
+    unknown = [name for name in names if name not in ids]
+    if unknown:
+        raise ValueError("Unknown ORC columns {}".format(unknown))
+    return [ids[name] for name in names]
+
+
+class OrcTweetWriter:
+    DEFAULT_BATCH_SIZE = 10000
+    DEFAULT_STRIPE_SIZE_MB = 64
+    DEFAULT_ROW_INDEX_STRIDE = 10000
+    DEFAULT_BLOOM_FILTER_FPP = 0.05
+
+    def __init__(self, orc_file, batch_size=DEFAULT_BATCH_SIZE, options=None):
+        import pyarrow.json
+        import pyarrow.orc
+        self.pyarrow = pyarrow
+        self.schema = tweet_schema()
+        # fields that are not in STRUCTURE_TWEET_ATHENA are dropped, like orc-tools did
+        self.parse_options = pyarrow.json.ParseOptions(explicit_schema=self.schema,
+                                                       unexpected_field_behavior='ignore')
+        # stripe_size, row_index_stride, bloom_filter_fpp and bloom_filter_columns (by name) of ORCWriter
+        options = dict(options or {})
+        if options.get('bloom_filter_columns'):
+            options['bloom_filter_columns'] = orc_column_ids(self.schema, options['bloom_filter_columns'])
+        self.writer = pyarrow.orc.ORCWriter(orc_file if hasattr(orc_file, 'write') else str(orc_file),
+                                            compression='zlib', **options)
+        self.batch_size = batch_size
+        self.batch = []
+
+    def write(self, json_line):
+        self.batch.append(json_line.encode('utf-8'))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.batch.append(b'')
+            table = self.pyarrow.json.read_json(self.pyarrow.BufferReader(b'\n'.join(self.batch)),
+                                                parse_options=self.parse_options)
+            self.writer.write(table.select(self.schema.names))
+            self.batch = []
+
+    def append_orc(self, orc_file):
+        # copy the stripes of another ORC file with the same schema (the parts of a parallel export)
+        orc_reader = self.pyarrow.orc.ORCFile(str(orc_file))
+        for i in range(orc_reader.nstripes):
+            self.writer.write(self.pyarrow.Table.from_batches([orc_reader.read_stripe(i)]))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
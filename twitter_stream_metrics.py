@@ -0,0 +1,437 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+import time as clock
+import io
+import sys
+import signal
+import cProfile
+import pstats
+import tracemalloc
+import logging
+import threading
+import boto3
+
+
+# Upper bounds (in seconds) of the latency histograms: from tens of microseconds for on_data
+# to seconds for a SQLite commit on a slow disk
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+# gaps in the stream last from a quick reconnection to many minutes of backing off after a 420
+GAP_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def label_text(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+
+class Metrics:
+    # Counters, gauges and histograms kept in memory and rendered in the Prometheus text format.
+    # Gauges may be functions, evaluated only when the metrics are read (disk usage, queue size...).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def stage(self, stage, **labels):
+        # time one stage of the export and upload: kept as a gauge and written to the log
+        started = clock.monotonic()
+        try:
+            with PROFILER.profile(stage):
+                yield
+        finally:
+            elapsed = clock.monotonic() - started
+            self.set('twitter_stream_stage_seconds', elapsed, stage=stage, **labels)
+            logging.info("Stage %s%s took %.2f seconds", stage, label_text(label_key(labels)), elapsed)
+
+    def total(self, name, **labels):
+        # add up every label combination of a counter that has the given labels
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(value for (counter, key), value in self.counters.items()
+                       if counter == name and wanted.issubset(key))
+
+    def mean(self, name):
+        with self.lock:
+            histograms = [histogram for (histogram_name, key), histogram in self.histograms.items()
+                          if histogram_name == name]
+            count = sum(histogram.count for histogram in histograms)
+            return sum(histogram.sum for histogram in histograms) / count if count else 0.0
+
+    def gauge(self, name):
+        with self.lock:
+            values = [value for (gauge, key), value in self.gauges.items() if gauge == name]
+        return sum(value() if callable(value) else value for value in values)
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items(), key=lambda item: item[0])
+            histograms = [(key, list(histogram.counts), histogram.sum, histogram.count, histogram.buckets)
+                          for key, histogram in sorted(self.histograms.items(), key=lambda item: item[0])]
+        lines = []
+        described = set()
+
+        def header(name, metric_type):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append("# HELP {} {}".format(name, self.help[name]))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+
+        for (name, key), value in counters:
+            header(name, 'counter')
+            lines.append("{}{} {}".format(name, label_text(key), value))
+        for (name, key), value in gauges:
+            header(name, 'gauge')
+            try:
+                value = value() if callable(value) else value
+            except Exception:
+                # a gauge that cannot be read now (a file being rotated...) is left out of this scrape
+                continue
+            lines.append("{}{} {}".format(name, label_text(key), value))
+        for (name, key), counts, total, count, buckets in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative = cumulative + bucket_count
+                lines.append("{}_bucket{} {}".format(name, label_text(key, [('le', bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(name, label_text(key), total))
+            lines.append("{}_count{} {}".format(name, label_text(key), count))
+        return "\n".join(lines) + "\n"
+
+
+# one registry for the whole process: every filter and shard adds its own labels
+METRICS = Metrics()
+METRICS.describe('twitter_stream_messages_total', 'Messages delivered by the streaming API')
+METRICS.describe('twitter_stream_tweets_total', 'Tweets saved or skipped (outside the time window or duplicated)')
+METRICS.describe('twitter_stream_limit_notices_total', 'Limit notices received')
+METRICS.describe('twitter_stream_reconnects_total', 'Connections reopened after a network error, stall or HTTP error')
+METRICS.describe('twitter_stream_gap_seconds', 'Time between the last tweet before a disconnection and the first after')
+METRICS.describe('twitter_stream_on_data_seconds', 'Time spent in TwitterListener.on_data')
+METRICS.describe('twitter_stream_sqlite_write_seconds', 'Time to write one batch of tweets to SQLite')
+METRICS.describe('twitter_stream_queue_size', 'Messages waiting for the writer threads')
+METRICS.describe('twitter_stream_disk_bytes', 'Bytes used by the working directory')
+METRICS.describe('twitter_stream_stored_tweets_total', 'Tweets stored with slim storage or blob compression')
+METRICS.describe('twitter_stream_payload_bytes_total',
+                 'Bytes of the tweets received and stored with slim storage or blob compression')
+METRICS.describe('twitter_stream_stage_seconds', 'Duration of the last run of each export and upload stage')
+
+
+class Profiler:
+    # On-demand profiling of the running collector, so that a slow day can be looked into without restarting
+    # (and losing tweets). start() samples the stacks of every thread (shards, writers, exporters) for a
+    # number of seconds; with stages on, each stage timed by Metrics.stage runs under cProfile. Both can also
+    # take tracemalloc snapshots. The results are saved to the profile directory and uploaded next to the logs.
+    DEFAULT_SECONDS = 60
+    DEFAULT_INTERVAL_MS = 10
+    DEFAULT_MEMORY_FRAMES = 10
+    TOP = 20
+
+    def __init__(self):
+        self.directory = None
+        self.seconds = self.DEFAULT_SECONDS
+        self.interval_ms = self.DEFAULT_INTERVAL_MS
+        self.stages = False
+        self.memory_frames = 0
+        self.s3_bucket = None
+        self.lock = threading.Lock()
+        self.sampling = False
+        self.tracing = 0
+        self.local = threading.local()
+
+    def configure(self, directory, seconds=DEFAULT_SECONDS, interval_ms=DEFAULT_INTERVAL_MS, stages=False,
+                  memory_frames=DEFAULT_MEMORY_FRAMES, s3_bucket=None):
+        self.directory = Path(directory)
+        self.seconds = seconds
+        self.interval_ms = interval_ms
+        self.stages = stages
+        self.memory_frames = memory_frames
+        self.s3_bucket = s3_bucket
+
+    def start(self, seconds=None):
+        # return at once: called from signal handlers
+        with self.lock:
+            if self.directory is None or self.sampling:
+                return False
+            self.sampling = True
+        threading.Thread(target=self.__sample, args=(seconds or self.seconds,), name="profiler",
+                         daemon=True).start()
+        return True
+
+    def __sample(self, seconds):
+        name = self.__name('sample')
+        logging.info("Profile every thread for %s seconds: sample stacks every %s ms", seconds, self.interval_ms)
+        traced = False
+        try:
+            traced = self.__trace_memory()
+            stacks = Counter()
+            me = threading.get_ident()
+            threads = {}
+            samples = 0
+            ends = clock.monotonic() + seconds
+            while clock.monotonic() < ends:
+                for thread in threading.enumerate():
+                    threads[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append("{}:{}:{}".format(Path(code.co_filename).name, code.co_name, frame.f_lineno))
+                        frame = frame.f_back
+                    stack.append(threads.get(ident, str(ident)))
+                    stacks[';'.join(reversed(stack))] += 1
+                samples = samples + 1
+                clock.sleep(self.interval_ms / 1000)
+            self.__save_samples(name, stacks, samples)
+        except Exception:
+            logging.exception("Profiling failed")
+        finally:
+            self.__end_memory_trace(name, traced)
+            with self.lock:
+                self.sampling = False
+
+    def __save_samples(self, name, stacks, samples):
+        # collapsed stacks (thread;outermost;...;innermost count), the input of flamegraph.pl and speedscope
+        path = Path(self.directory, name + '.txt')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as output:
+            for stack, count in stacks.most_common():
+                output.write("{} {}\n".format(stack, count))
+        innermost = Counter()
+        for stack, count in stacks.items():
+            thread, _, frames = stack.partition(';')
+            innermost["{} {}".format(thread, frames.rpartition(';')[2])] += count
+        logging.info("%d samples saved to %s. Most frequent innermost frames:\n%s", samples, path,
+                     "\n".join("{:6.1%} {}".format(count / samples, frame)
+                               for frame, count in innermost.most_common(self.TOP)))
+        self.__upload(path)
+
+    @contextmanager
+    def profile(self, stage):
+        # stages nest (an export inside the processing of a day): only the outermost one of a thread is profiled
+        if not self.stages or self.directory is None or getattr(self.local, 'profiling', False):
+            yield
+            return
+        # filters export at the same time: the thread tells their profiles apart
+        name = self.__name("{}-{}".format(stage, threading.current_thread().name))
+        self.local.profiling = True
+        traced = False
+        profiler = None
+        try:
+            traced = self.__trace_memory()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        except Exception:
+            # profiling never fails a stage: ValueError when another profiler (python -m cProfile) is active
+            logging.exception("Stage %s runs without cProfile", stage)
+            profiler = None
+        try:
+            yield
+        finally:
+            self.local.profiling = False
+            if profiler is not None:
+                profiler.disable()
+                try:
+                    self.__save_profile(name, profiler)
+                except Exception:
+                    logging.exception("Could not save the profile of stage %s", stage)
+            self.__end_memory_trace(name, traced)
+
+    def __save_profile(self, name, profiler):
+        path = Path(self.directory, name + '.pstats')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(self.TOP)
+        logging.info("Profile saved to %s:\n%s", path, text.getvalue())
+        self.__upload(path)
+
+    def __trace_memory(self):
+        # True when the caller holds a reference to the tracing and must end it with __end_memory_trace
+        if not self.memory_frames:
+            return False
+        with self.lock:
+            if self.tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(self.memory_frames)
+            self.tracing = self.tracing + 1
+        return True
+
+    def __end_memory_trace(self, name, traced):
+        if not traced:
+            return
+        try:
+            self.__snapshot_memory(name)
+        except Exception:
+            logging.exception("Could not save the memory snapshot %s", name)
+
+    def __snapshot_memory(self, name):
+        # tracing slows allocations down: it only lasts as long as the profiles that asked for it
+        try:
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            with self.lock:
+                self.tracing = self.tracing - 1
+                if self.tracing == 0:
+                    tracemalloc.stop()
+        path = Path(self.directory, name + '.tracemalloc')
+        snapshot.dump(str(path))
+        logging.info("Memory snapshot saved to %s (tracemalloc.Snapshot.load). Largest allocations:\n%s", path,
+                     "\n".join(str(statistic) for statistic in snapshot.statistics('lineno')[:self.TOP]))
+        self.__upload(path)
+
+    def __name(self, kind):
+        return "{}-{}".format(datetime.utcnow().strftime("%Y%m%d-%H%M%S"), kind)
+
+    def __upload(self, path):
+        if self.s3_bucket is None:
+            return
+        key = "profile/twitter_stream/{}/{}".format(datetime.utcnow().strftime("%Y-%m-%d"), path.name)
+        logging.info("Upload %s to bucket %s at %s", path, self.s3_bucket, key)
+        boto3.client('s3').upload_file(str(path), self.s3_bucket, key)
+
+
+# the collector and the export stages share one profiler, configured by main
+PROFILER = Profiler()
+
+
+def configure_profiler(config, directory):
+    # kill -USR1 <pid> profiles the running process for profile_seconds
+    PROFILER.configure(directory=directory,
+                       seconds=config['twitter_stream'].get('profile_seconds', Profiler.DEFAULT_SECONDS),
+                       interval_ms=config['twitter_stream'].get('profile_interval_ms', Profiler.DEFAULT_INTERVAL_MS),
+                       stages=config['twitter_stream'].get('profile_stages', False),
+                       memory_frames=config['twitter_stream'].get('profile_memory_frames',
+                                                                  Profiler.DEFAULT_MEMORY_FRAMES),
+                       s3_bucket=config['aws']['s3-admin'])
+    signal.signal(signal.SIGUSR1, lambda signum, frame: PROFILER.start())
+    if config['twitter_stream'].get('profile_start'):
+        PROFILER.start()
+
+
+def directory_size(directory):
+    return sum(path.stat().st_size for path in directory.rglob('*') if path.is_file())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the log saved by AthenaLogger
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    logging.info("Serve metrics at http://%s:%d/metrics", host, port)
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
+
+
+class MetricsReporter:
+    # Writes one summary line into the log every interval seconds, with rates since the previous line
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__work, name="metrics-reporter", daemon=True)
+        self.last = None
+
+    def start(self):
+        self.last = self.__snapshot()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+    def __snapshot(self):
+        return (clock.monotonic(),
+                METRICS.total('twitter_stream_messages_total'),
+                METRICS.total('twitter_stream_tweets_total', status='saved'),
+                METRICS.total('twitter_stream_tweets_total', status='duplicate') +
+                METRICS.total('twitter_stream_tweets_total', status='out_of_window'))
+
+    def report(self):
+        now = self.__snapshot()
+        elapsed = max(now[0] - self.last[0], 1e-9)
+        rates = [(current - previous) / elapsed for current, previous in zip(now[1:], self.last[1:])]
+        self.last = now
+        try:
+            disk_bytes = METRICS.gauge('twitter_stream_disk_bytes')
+        except OSError:
+            disk_bytes = 0
+        logging.info("Metrics: %.1f messages/s - %.1f tweets saved/s - %.1f tweets skipped/s - "
+                     "on_data %.3f ms - SQLite batch %.1f ms - queue %d - reconnects %d - limit notices %d - "
+                     "disk %.1f Mb",
+                     rates[0], rates[1], rates[2],
+                     METRICS.mean('twitter_stream_on_data_seconds') * 1000,
+                     METRICS.mean('twitter_stream_sqlite_write_seconds') * 1000,
+                     METRICS.gauge('twitter_stream_queue_size'),
+                     METRICS.total('twitter_stream_reconnects_total'),
+                     METRICS.total('twitter_stream_limit_notices_total'),
+                     disk_bytes / 2 ** 20)
+
+    def __work(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
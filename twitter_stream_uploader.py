@@ -1,12 +1,20 @@
 import argparse
+import os
+import copy
 import time
+import base64
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from internet_scholar import AthenaLogger, read_dict_from_s3_url, AthenaDatabase, s3_file_size_in_bytes
 import logging
 import shutil
 import boto3
 import json
 import sqlite3
+import threading
 from pathlib import Path
+from twitter_stream_export import compressed_file_name, hour_directory, export_tweets, OrcTweetWriter
+from twitter_stream_metrics import METRICS, configure_profiler
 
 
 STRUCTURE_TWEET_ATHENA = """
@@ -341,10 +349,10 @@ ATHENA_CREATE_TWITTER_STREAM = """
 CREATE EXTERNAL TABLE IF NOT EXISTS twitter_stream (
 {structure}
 )
-PARTITIONED BY (filter String, creation_date String)
+PARTITIONED BY ({partition_keys})
 STORED AS ORC
 LOCATION '{bucket}'
-tblproperties ("orc.compress"="ZLIB");
+tblproperties ("orc.compress"="ZLIB"{properties});
 """
 
 ATHENA_CREATE_TWITTER_STREAM_RAW = """
@@ -352,15 +360,340 @@ CREATE EXTERNAL TABLE IF NOT EXISTS twitter_stream_raw (
 timestamp_ms bigint,
 {structure}
 )
-PARTITIONED BY (filter String, creation_date String)
+PARTITIONED BY ({partition_keys})
 ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
 WITH SERDEPROPERTIES (
   'serialization.format' = '1',
   'ignore.malformed.json' = 'true'
 ) LOCATION '{bucket}'
-TBLPROPERTIES ('has_encrypted_data'='false');
+TBLPROPERTIES ('has_encrypted_data'='false'{properties});
 """
 
+# Partition projection: Athena computes the partitions from the query instead of reading them from the catalog.
+# filter is injected, so queries on these tables must say which filter they want.
+ATHENA_PARTITION_PROJECTION = """
+'projection.enabled'='true',
+'projection.filter.type'='injected',
+'projection.creation_date.type'='date',
+'projection.creation_date.format'='yyyy-MM-dd',
+'projection.creation_date.range'='2019-01-01,NOW',
+'projection.creation_date.interval'='1',
+'projection.creation_date.interval.unit'='DAYS',
+'storage.location.template'='{bucket}filter=${{filter}}/creation_date=${{creation_date}}/'
+"""
+
+ATHENA_ADD_PARTITION = """
+ALTER TABLE {table} ADD IF NOT EXISTS
+PARTITION (filter='{filter}', creation_date='{creation_date}')
+LOCATION '{bucket}filter={filter}/creation_date={creation_date}/'
+"""
+
+# Hourly partitions: one file per UTC hour of created_at, so that queries on a few hours read only those files
+ATHENA_PARTITION_KEYS = "filter String, creation_date String"
+ATHENA_HOURLY_PARTITION_KEYS = "filter String, creation_date String, hour String"
+
+ATHENA_HOURLY_PARTITION_PROJECTION = """
+'projection.enabled'='true',
+'projection.filter.type'='injected',
+'projection.creation_date.type'='date',
+'projection.creation_date.format'='yyyy-MM-dd',
+'projection.creation_date.range'='2019-01-01,NOW',
+'projection.creation_date.interval'='1',
+'projection.creation_date.interval.unit'='DAYS',
+'projection.hour.type'='integer',
+'projection.hour.range'='0,23',
+'projection.hour.digits'='2',
+'storage.location.template'='{bucket}filter=${{filter}}/creation_date=${{creation_date}}/hour=${{hour}}/'
+"""
+
+ATHENA_ADD_HOURLY_PARTITIONS = """
+ALTER TABLE {table} ADD IF NOT EXISTS
+{partitions}
+"""
+
+ATHENA_HOURLY_PARTITION = """
+PARTITION (filter='{filter}', creation_date='{creation_date}', hour='{hour}')
+LOCATION '{bucket}filter={filter}/creation_date={creation_date}/hour={hour}/'
+"""
+
+
+def set_s3_endpoint(endpoint_url):
+    # Point every S3 client (ours and internet_scholar's) to a local S3 stand-in such as MinIO or moto
+    if endpoint_url:
+        logging.info("Use S3 endpoint %s", endpoint_url)
+        os.environ['AWS_ENDPOINT_URL_S3'] = endpoint_url
+
+
+def s3_key(table, filter_name, creation_date, file_name, hour=None):
+    if hour is not None:
+        return "{}/filter={}/creation_date={}/hour={}/{}".format(table, filter_name, creation_date, hour, file_name)
+    return "{}/filter={}/creation_date={}/{}".format(table, filter_name, creation_date, file_name)
+
+
+def twitter_filters(config):
+    # Return (twitter_filter, credentials, work_dir) for every filter collected by this process. The original
+    # config has a single twitter_filter that works on tmp/; twitter_filters lists several filters, each one
+    # with its own credentials, that are collected side by side and work on tmp/<filter name>/
+    base_dir = Path(Path(__file__).parent, 'tmp')
+    if 'twitter_filters' not in config:
+        return [(config['twitter_filter'], config['twitter_credentials'], base_dir)]
+    return [(item['filter'], item['credentials'], Path(base_dir, item['filter']['name']))
+            for item in config['twitter_filters']]
+
+
+class MultipartUploader:
+    # Uploads a file in parts, several at a time. Parts already sent by an interrupted run are found with
+    # list_parts and kept when their MD5 matches the local part, so a retry only sends what is missing.
+    # Every file (and stream) uploaded with the same uploader shares concurrency slots, so at most
+    # concurrency parts are in memory at once: 64 Mb with the defaults, enough for a t3a.nano.
+    DEFAULT_PART_SIZE_MB = 16
+    DEFAULT_CONCURRENCY = 4
+
+    def __init__(self, s3_bucket, part_size_mb=DEFAULT_PART_SIZE_MB, concurrency=DEFAULT_CONCURRENCY):
+        self.s3_bucket = s3_bucket
+        self.part_size = part_size_mb * 2 ** 20
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.s3 = boto3.client('s3')
+
+    def checksums(self, file):
+        sha256 = hashlib.sha256()
+        part_md5s = []
+        with open(file, 'rb') as file_reader:
+            while True:
+                data = file_reader.read(self.part_size)
+                if not data and part_md5s:
+                    break
+                sha256.update(data)
+                part_md5s.append(hashlib.md5(data).hexdigest())
+                if len(data) < self.part_size:
+                    break
+        return sha256.hexdigest(), part_md5s
+
+    @staticmethod
+    def expected_etag(part_md5s):
+        if len(part_md5s) == 1:
+            return part_md5s[0]
+        return "{}-{}".format(hashlib.md5(b''.join(bytes.fromhex(md5) for md5 in part_md5s)).hexdigest(),
+                              len(part_md5s))
+
+    def current_etag(self, key):
+        try:
+            return self.s3.head_object(Bucket=self.s3_bucket, Key=key)['ETag'].strip('"')
+        except self.s3.exceptions.ClientError:
+            return None
+
+    def upload(self, file, key, manifest_entry=None):
+        size = Path(file).stat().st_size
+        sha256, part_md5s = self.checksums(file)
+        if manifest_entry is not None and manifest_entry['sha256'] == sha256 and manifest_entry['size'] == size \
+                and self.current_etag(key) == manifest_entry['etag']:
+            logging.info("Skip %s: already uploaded to %s and verified", file, key)
+            return manifest_entry
+
+        logging.info("Upload %s (%d parts) to bucket %s at %s", file, len(part_md5s), self.s3_bucket, key)
+        if len(part_md5s) == 1:
+            with self.slots, open(file, 'rb') as file_reader:
+                response = self.s3.put_object(Bucket=self.s3_bucket, Key=key, Body=file_reader,
+                                              ContentMD5=base64.b64encode(bytes.fromhex(part_md5s[0])).decode())
+        else:
+            response = self.__upload_parts(file, key, size, part_md5s)
+        etag = response['ETag'].strip('"')
+        if etag != self.expected_etag(part_md5s):
+            raise ValueError("Upload of {} to {} failed verification: ETag {} instead of {}".format(
+                file, key, etag, self.expected_etag(part_md5s)))
+        return {'size': size, 'sha256': sha256, 'etag': etag, 'part_size': self.part_size, 'parts': part_md5s}
+
+    def open_upload(self, key):
+        # the latest multipart upload of key left by an interrupted run (older ones are aborted) with its
+        # parts as {number: (ETag, size)}, or a new multipart upload
+        uploads = self.s3.list_multipart_uploads(Bucket=self.s3_bucket, Prefix=key).get('Uploads', [])
+        uploads = sorted([upload for upload in uploads if upload['Key'] == key], key=lambda upload: upload['Initiated'])
+        for upload in uploads[:-1]:
+            self.s3.abort_multipart_upload(Bucket=self.s3_bucket, Key=key, UploadId=upload['UploadId'])
+        if not uploads:
+            return self.s3.create_multipart_upload(Bucket=self.s3_bucket, Key=key)['UploadId'], None
+        upload_id = uploads[-1]['UploadId']
+        parts = {}
+        paginator = self.s3.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.s3_bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = (part['ETag'], part['Size'])
+        return upload_id, parts
+
+    def upload_part(self, key, upload_id, number, data, md5):
+        response = self.s3.upload_part(Bucket=self.s3_bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                       Body=data, ContentMD5=base64.b64encode(bytes.fromhex(md5)).decode())
+        return response['ETag']
+
+    def __resume(self, key, size, part_md5s):
+        upload_id, parts = self.open_upload(key)
+        uploaded = {}
+        if parts is not None:
+            for number, (etag, part_size) in parts.items():
+                expected_size = min(self.part_size, size - (number - 1) * self.part_size)
+                if number <= len(part_md5s) and part_size == expected_size \
+                        and etag.strip('"') == part_md5s[number - 1]:
+                    uploaded[number] = etag
+            logging.info("Resume upload of %s: %d of %d parts already uploaded", key, len(uploaded), len(part_md5s))
+        return upload_id, uploaded
+
+    def __upload_parts(self, file, key, size, part_md5s):
+        upload_id, uploaded = self.__resume(key, size, part_md5s)
+
+        def upload_part(number):
+            # the part is only read once it has a slot
+            with self.slots:
+                with open(file, 'rb') as file_reader:
+                    file_reader.seek((number - 1) * self.part_size)
+                    data = file_reader.read(self.part_size)
+                return number, self.upload_part(key, upload_id, number, data, part_md5s[number - 1])
+
+        missing = [number for number in range(1, len(part_md5s) + 1) if number not in uploaded]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for number, etag in executor.map(upload_part, missing):
+                uploaded[number] = etag
+        return self.s3.complete_multipart_upload(
+            Bucket=self.s3_bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': uploaded[number]}
+                                       for number in sorted(uploaded)]})
+
+
+class MultipartStream:
+    # Write-only file that sends what is written to it as the parts of a multipart upload, for exports that
+    # never touch the disk. The parts being uploaded take the slots of the uploader, shared with the other
+    # streams, so at most concurrency parts are in memory plus the one each stream is filling. The export is
+    # deterministic, so when an interrupted upload is resumed the parts it already has come out again with the
+    # same MD5 and size and are kept instead of being sent again.
+    # close() only ends the writing: complete() makes the object visible, once the whole export succeeded.
+    def __init__(self, uploader, key):
+        self.uploader = uploader
+        self.key = key
+        self.part_size = uploader.part_size
+        self.upload_id, self.previous_parts = uploader.open_upload(key)
+        if self.previous_parts:
+            logging.info("Resume streaming upload of %s: %d parts already uploaded", key, len(self.previous_parts))
+        self.previous_parts = self.previous_parts or {}
+        self.buffer = bytearray()
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.part_md5s = []
+        self.etags = {}
+        self.futures = []
+        self.slots = uploader.slots
+        self.executor = ThreadPoolExecutor(max_workers=uploader.concurrency)
+        self.closed = False
+        self.kept = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.__submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.size + len(self.buffer)
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def __submit(self, data):
+        number = len(self.part_md5s) + 1
+        md5 = hashlib.md5(data).hexdigest()
+        self.part_md5s.append(md5)
+        self.sha256.update(data)
+        self.size = self.size + len(data)
+        previous = self.previous_parts.get(number)
+        if previous is not None and previous[0].strip('"') == md5 and previous[1] == len(data):
+            self.etags[number] = previous[0]
+            self.kept = self.kept + 1
+            return
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self.__upload_part, number, data, md5))
+        # surface a failed part now rather than after the whole export
+        while self.futures and self.futures[0].done():
+            number, etag = self.futures.pop(0).result()
+            self.etags[number] = etag
+
+    def __upload_part(self, number, data, md5):
+        try:
+            return number, self.uploader.upload_part(self.key, self.upload_id, number, data, md5)
+        finally:
+            self.slots.release()
+
+    def complete(self):
+        # send the last part, wait for the others and complete the upload; returns its manifest entry
+        try:
+            if self.buffer or not self.part_md5s:
+                self.__submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            for future in self.futures:
+                number, etag = future.result()
+                self.etags[number] = etag
+            self.futures = []
+        finally:
+            self.executor.shutdown()
+        logging.info("Complete upload of %s: %d parts (%d kept from an interrupted upload), %.1f Mb", self.key,
+                     len(self.part_md5s), self.kept, self.size / 2 ** 20)
+        response = self.uploader.s3.complete_multipart_upload(
+            Bucket=self.uploader.s3_bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': self.etags[number]}
+                                       for number in sorted(self.etags)]})
+        etag = response['ETag'].strip('"')
+        expected = "{}-{}".format(hashlib.md5(b''.join(bytes.fromhex(md5) for md5 in self.part_md5s)).hexdigest(),
+                                  len(self.part_md5s))
+        if etag != expected:
+            raise ValueError("Upload to {} failed verification: ETag {} instead of {}".format(self.key, etag,
+                                                                                             expected))
+        return {'size': self.size, 'sha256': self.sha256.hexdigest(), 'etag': etag, 'part_size': self.part_size,
+                'parts': self.part_md5s}
+
+    def abandon(self):
+        # keep the uploaded parts for the next attempt
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+
+
+class AthenaDdlCache:
+    # Remembers in S3 a fingerprint of the DDL each Athena table was created with, so that a table is only
+    # dropped and created again when its definition changes
+    def __init__(self, s3_bucket, athena_db):
+        self.s3_bucket = s3_bucket
+        self.athena_db = athena_db
+        self.s3 = boto3.client('s3')
+
+    def __key(self, table):
+        return "athena_ddl/{}/{}.sha256".format(self.athena_db, table)
+
+    def get(self, table):
+        try:
+            return self.s3.get_object(Bucket=self.s3_bucket, Key=self.__key(table))['Body'].read().decode()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    def put(self, table, fingerprint):
+        self.s3.put_object(Bucket=self.s3_bucket, Key=self.__key(table), Body=fingerprint.encode())
+
+
+def ddl_fingerprint(create_statement):
+    return hashlib.sha256(create_statement.encode()).hexdigest()
+
+
+def run_concurrently(*functions):
+    # Athena runs independent statements (and we run independent filters) in parallel:
+    # submit them together and wait for all of them
+    with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+        futures = [executor.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
 
 class TwitterFilter:
     __CREATE_ATHENA_TABLE = """
@@ -384,27 +717,61 @@ class TwitterFilter:
         logging.info("Save twitter filter parameters to bucket %s at %s", self.s3_bucket, s3_filename)
         s3.Object(self.s3_bucket, s3_filename).put(Body=json.dumps(self.filter))
 
-    def recreate_athena_table(self):
-        logging.info("Create Athena instance.")
-        athena = AthenaDatabase(s3_output=self.s3_bucket, database=self.athena_db)
+    def recreate_athena_table(self, athena=None, ddl_cache=None):
+        if athena is None:
+            logging.info("Create Athena instance.")
+            athena = AthenaDatabase(s3_output=self.s3_bucket, database=self.athena_db)
+        if ddl_cache is None:
+            ddl_cache = AthenaDdlCache(s3_bucket=self.s3_bucket, athena_db=self.athena_db)
+        create_statement = self.__CREATE_ATHENA_TABLE.format(s3_location=self.s3_bucket)
+        fingerprint = ddl_fingerprint(create_statement)
+        if ddl_cache.get('twitter_filter') == fingerprint:
+            logging.info("Table twitter_filter is up to date")
+            return
         logging.info("Delete table twitter_filter if exists")
         athena.query_athena_and_wait(query_string='DROP TABLE if exists twitter_filter')
         logging.info("Recreate table twitter_filter on %s", self.s3_bucket)
-        athena.query_athena_and_wait(query_string=self.__CREATE_ATHENA_TABLE.format(s3_location=self.s3_bucket))
+        athena.query_athena_and_wait(query_string=create_statement)
+        ddl_cache.put('twitter_filter', fingerprint)
 
 
 class TwitterStreamUploader:
-    def __init__(self, s3_bucket, athena_db, aws_region):
+    # add: register the new partition; projection: no partition metadata at all;
+    # msck: drop and recreate the tables and scan the whole bucket for partitions (the old behaviour)
+    PARTITION_MODES = ('add', 'projection', 'msck')
+
+    def __init__(self, s3_bucket, athena_db, aws_region, compression='bz2', segmented=False,
+                 part_size_mb=MultipartUploader.DEFAULT_PART_SIZE_MB,
+                 upload_concurrency=MultipartUploader.DEFAULT_CONCURRENCY, partition_mode='add', work_dir=None,
+                 hourly=False, stream_export=False, compression_workers=None, orc_options=None):
         self.s3_bucket = s3_bucket
+        self.work_dir = Path(work_dir) if work_dir is not None else Path(Path(__file__).parent, 'tmp')
         self.athena_db = athena_db
         self.aws_region = aws_region
+        self.compression = compression
+        self.segmented = segmented
+        self.part_size_mb = part_size_mb
+        self.upload_concurrency = upload_concurrency
+        if partition_mode not in self.PARTITION_MODES:
+            raise ValueError("Unknown partition mode {}: use one of {}".format(partition_mode, self.PARTITION_MODES))
+        self.partition_mode = partition_mode
+        self.hourly = hourly
+        # export the day database straight into S3 instead of uploading the files twitter_stream.py exported
+        self.stream_export = stream_export
+        if self.stream_export and (self.hourly or self.segmented):
+            raise ValueError("Streaming export uploads whole days: it does not work with hourly partitions "
+                             "or segment rotation")
+        self.compression_workers = compression_workers
+        self.orc_options = orc_options
 
-    def save_to_s3(self, delay=0):
-        logging.info("BEGIN: Save twitter_stream to S3")
+    def for_work_dir(self, work_dir):
+        # the same settings for the files of another directory (a finished day of the daemon)
+        uploader = copy.copy(self)
+        uploader.work_dir = Path(work_dir)
+        return uploader
 
-        if delay != 0:
-            time.sleep(delay*60)
-        db_name = Path(Path(__file__).parent, 'tmp', 'tweets.sqlite')
+    def __read_athena_prefix(self):
+        db_name = Path(self.work_dir, 'tweets.sqlite')
         logging.info("Obtain athena prefix from database %s", db_name)
         database = sqlite3.connect(str(db_name), isolation_level=None)
         database.row_factory = sqlite3.Row
@@ -412,39 +779,187 @@ class TwitterStreamUploader:
         cursor_prefix.execute("select * from athena_prefix")
         athena_prefix = cursor_prefix.fetchone()
         database.close()
+        return athena_prefix
 
-        s3 = boto3.resource('s3')
+    def __upload_files(self, files, filter_name, creation_date):
+        # Upload the files of one day (one partition or its hourly partitions) concurrently and record their
+        # checksums in the day's manifest, kept outside the table locations so that Athena does not read it
+        # as data. Each file is (table, file, hour), hour being None for daily partitions.
+        manifest = self.__read_manifest(filter_name, creation_date)
+        uploader = MultipartUploader(s3_bucket=self.s3_bucket,
+                                     part_size_mb=self.part_size_mb,
+                                     concurrency=self.upload_concurrency)
+        try:
+            with ThreadPoolExecutor(max_workers=min(len(files), self.upload_concurrency)) as executor:
+                futures = {}
+                for table, file, hour in files:
+                    key = s3_key(table, filter_name, creation_date, file.name, hour)
+                    futures[key] = executor.submit(uploader.upload, file, key, manifest.get(key))
+                for key, future in futures.items():
+                    manifest[key] = future.result()
+        finally:
+            self.__save_manifest(filter_name, creation_date, manifest)
 
-        bz2_file = Path(Path(__file__).parent, 'tmp', 'twitter_stream.json.bz2')
-        orc_file = Path(Path(__file__).parent, 'tmp', 'twitter_stream.orc')
-        s3_filename = "twitter_stream_raw/filter={}/creation_date={}/{}.json.bz2".format(athena_prefix['filter'],
-                                                                                         athena_prefix['creation_date'],
-                                                                                         'twitter_stream')
-        saved = False
-        s3_size = s3_file_size_in_bytes(bucket=self.s3_bucket, key=s3_filename)
-        file_size = bz2_file.stat().st_size
-        logging.info(f"S3 file size: {s3_size}. Local file size: {file_size}.")
-        if s3_size > file_size:
-            logging.info("Will not upload because current file on S3 is bigger")
-        else:
-            saved = True
-            logging.info("Upload file %s to bucket %s at %s", bz2_file, self.s3_bucket, s3_filename)
-            s3.Bucket(self.s3_bucket).upload_file(str(bz2_file), s3_filename)
-            s3_filename = "twitter_stream/filter={}/creation_date={}/{}.orc".format(athena_prefix['filter'],
-                                                                                    athena_prefix['creation_date'],
-                                                                                    'twitter_stream')
-            logging.info("Upload file %s to bucket %s at %s", orc_file, self.s3_bucket, s3_filename)
-            s3.Bucket(self.s3_bucket).upload_file(str(orc_file), s3_filename)
-
-        logging.info("File sizes - SQLite: %.1f Mb - BZIP2: %.1f Mb - ORC: %.1f Mb",
+    def __read_manifest(self, filter_name, creation_date):
+        s3 = boto3.client('s3')
+        manifest_key = s3_key('twitter_stream_manifest', filter_name, creation_date, 'manifest.json')
+        try:
+            return json.loads(s3.get_object(Bucket=self.s3_bucket, Key=manifest_key)['Body'].read())
+        except s3.exceptions.NoSuchKey:
+            return {}
+
+    def __save_manifest(self, filter_name, creation_date, manifest):
+        manifest_key = s3_key('twitter_stream_manifest', filter_name, creation_date, 'manifest.json')
+        logging.info("Save upload manifest to bucket %s at %s", self.s3_bucket, manifest_key)
+        boto3.client('s3').put_object(Bucket=self.s3_bucket, Key=manifest_key, Body=json.dumps(manifest, indent=2))
+
+    def __stream_to_s3(self, athena_prefix):
+        # Export the day database through compression straight into multipart uploads: no JSON or ORC file
+        # is written to disk. A day whose tweets were all streamed already (same count, objects unchanged)
+        # is skipped, but still reported as saved: a run that stopped before updating the partitions updates
+        # them now. An interrupted day starts again and keeps the parts S3 already has.
+        db_name = Path(self.work_dir, 'tweets.sqlite')
+        filter_name, creation_date = athena_prefix['filter'], athena_prefix['creation_date']
+        json_key = s3_key('twitter_stream_raw', filter_name, creation_date,
+                          compressed_file_name('twitter_stream.json', self.compression))
+        orc_key = s3_key('twitter_stream', filter_name, creation_date, 'twitter_stream.orc')
+        database = sqlite3.connect(str(db_name), isolation_level=None)
+        tweets = database.execute("select count(*) from tweet").fetchone()[0]
+        database.close()
+        manifest = self.__read_manifest(filter_name, creation_date)
+        uploader = MultipartUploader(s3_bucket=self.s3_bucket,
+                                     part_size_mb=self.part_size_mb,
+                                     concurrency=self.upload_concurrency)
+        if all(manifest.get(key, {}).get('tweets') == tweets and
+               uploader.current_etag(key) == manifest[key]['etag'] for key in (json_key, orc_key)):
+            logging.info("Will not stream %s: its %d tweets are already in S3", db_name, tweets)
+            return True
+
+        logging.info("Stream %d tweets from %s to bucket %s at %s and %s", tweets, db_name, self.s3_bucket,
+                     json_key, orc_key)
+        json_stream = MultipartStream(uploader, json_key)
+        orc_stream = MultipartStream(uploader, orc_key)
+        try:
+            with METRICS.stage('stream_export', filter=filter_name):
+                count = export_tweets(db_name=db_name, json_file=json_stream, orc_file=orc_stream,
+                                      compression=self.compression, compression_workers=self.compression_workers,
+                                      orc_options=self.orc_options)
+                manifest[json_key] = dict(json_stream.complete(), tweets=count)
+                manifest[orc_key] = dict(orc_stream.complete(), tweets=count)
+        except Exception:
+            json_stream.abandon()
+            orc_stream.abandon()
+            raise
+        self.__save_manifest(filter_name, creation_date, manifest)
+        logging.info("File sizes - SQLite: %.1f Mb - %s: %.1f Mb - ORC: %.1f Mb (in S3 only)",
+                     db_name.stat().st_size / 2**20, self.compression.upper(), json_stream.size / 2**20,
+                     orc_stream.size / 2**20)
+        return True
+
+    def upload_segment(self, json_file, orc_file, filter_name, creation_date):
+        self.__upload_files([('twitter_stream_raw', json_file, None), ('twitter_stream', orc_file, None)],
+                            filter_name, creation_date)
+
+    def save_to_s3(self, delay=0):
+        logging.info("BEGIN: Save twitter_stream to S3")
+
+        if delay != 0:
+            time.sleep(delay*60)
+        db_name = Path(self.work_dir, 'tweets.sqlite')
+        athena_prefix = self.__read_athena_prefix()
+
+        if self.segmented:
+            logging.info("Segments of %s were uploaded while collecting: nothing to upload",
+                         athena_prefix['creation_date'])
+            logging.info("END: Save twitter_stream to S3")
+            return True
+        if self.stream_export:
+            saved = self.__stream_to_s3(athena_prefix)
+            logging.info("END: Save twitter_stream to S3")
+            return saved
+
+        files = []
+        for hour, bz2_file, orc_file in self.__partition_files():
+            s3_filename = s3_key('twitter_stream_raw', athena_prefix['filter'], athena_prefix['creation_date'],
+                                 bz2_file.name, hour)
+            s3_size = s3_file_size_in_bytes(bucket=self.s3_bucket, key=s3_filename)
+            file_size = bz2_file.stat().st_size
+            logging.info(f"S3 file size: {s3_size}. Local file size: {file_size}.")
+            if s3_size > file_size:
+                logging.info("Will not upload %s because current file on S3 is bigger", bz2_file)
+            else:
+                files.extend([('twitter_stream_raw', bz2_file, hour), ('twitter_stream', orc_file, hour)])
+        saved = len(files) > 0
+        if saved:
+            with METRICS.stage('upload', filter=athena_prefix['filter']):
+                self.__upload_files(files, athena_prefix['filter'], athena_prefix['creation_date'])
+
+        logging.info("File sizes - SQLite: %.1f Mb - %s: %.1f Mb - ORC: %.1f Mb",
                      db_name.stat().st_size / 2**20,
-                     bz2_file.stat().st_size / 2**20,
-                     orc_file.stat().st_size / 2**20)
+                     self.compression.upper(),
+                     sum(bz2_file.stat().st_size for _, bz2_file, _ in self.__partition_files()) / 2**20,
+                     sum(orc_file.stat().st_size for _, _, orc_file in self.__partition_files()) / 2**20)
 
         logging.info("END: Save twitter_stream to S3")
         return saved
 
-    def recreate_athena_table(self):
+    def __partition_files(self):
+        # (hour, JSON file, ORC file) of every partition to upload: the whole day, or each hour with tweets
+        json_name = compressed_file_name('twitter_stream.json', self.compression)
+        if not self.hourly:
+            return [(None, Path(self.work_dir, json_name), Path(self.work_dir, 'twitter_stream.orc'))]
+        partitions = []
+        for hour in range(24):
+            json_file = Path(hour_directory(self.work_dir, hour), json_name)
+            if json_file.exists() and json_file.stat().st_size > 0:
+                partitions.append(("{:02d}".format(hour), json_file,
+                                   Path(hour_directory(self.work_dir, hour), 'twitter_stream.orc')))
+        return partitions
+
+    def __update_table(self, athena, ddl_cache, table, create_table, athena_prefix):
+        bucket = "s3://{}/{}/".format(self.s3_bucket, table)
+        properties = ''
+        if self.partition_mode == 'projection':
+            projection = ATHENA_HOURLY_PARTITION_PROJECTION if self.hourly else ATHENA_PARTITION_PROJECTION
+            properties = ",\n" + projection.format(bucket=bucket).strip()
+        create_statement = create_table.format(structure=STRUCTURE_TWEET_ATHENA, bucket=bucket, properties=properties,
+                                               partition_keys=ATHENA_HOURLY_PARTITION_KEYS if self.hourly
+                                               else ATHENA_PARTITION_KEYS)
+        fingerprint = ddl_fingerprint(create_statement)
+
+        if self.partition_mode == 'msck' or ddl_cache.get(table) != fingerprint:
+            logging.info("Drop and recreate table %s", table)
+            athena.query_athena_and_wait(query_string="drop table if exists {}".format(table))
+            athena.query_athena_and_wait(query_string=create_statement)
+            if self.partition_mode != 'projection':
+                # dropping the table also dropped the partitions: find all of them again
+                logging.info("Add all partitions of %s", table)
+                athena.query_athena_and_wait(query_string="MSCK REPAIR TABLE {}".format(table))
+            ddl_cache.put(table, fingerprint)
+        else:
+            logging.info("Table %s is up to date", table)
+
+        if self.partition_mode == 'add' and self.hourly:
+            hours = [hour for hour, _, _ in self.__partition_files()]
+            logging.info("Add partitions filter=%s/creation_date=%s/hour=%s to %s",
+                         athena_prefix['filter'], athena_prefix['creation_date'], ",".join(hours), table)
+            if hours:
+                athena.query_athena_and_wait(query_string=ATHENA_ADD_HOURLY_PARTITIONS.format(
+                    table=table,
+                    partitions="".join(ATHENA_HOURLY_PARTITION.format(filter=athena_prefix['filter'],
+                                                                      creation_date=athena_prefix['creation_date'],
+                                                                      hour=hour, bucket=bucket)
+                                       for hour in hours)))
+        elif self.partition_mode == 'add':
+            logging.info("Add partition filter=%s/creation_date=%s to %s",
+                         athena_prefix['filter'], athena_prefix['creation_date'], table)
+            athena.query_athena_and_wait(
+                query_string=ATHENA_ADD_PARTITION.format(table=table,
+                                                         filter=athena_prefix['filter'],
+                                                         creation_date=athena_prefix['creation_date'],
+                                                         bucket=bucket))
+
+    def recreate_athena_table(self, athena=None, ddl_cache=None):
         logging.info("BEGIN: Recreate Athena tables for twitter_stream")
 
         s3_client = boto3.client('s3')
@@ -457,51 +972,87 @@ class TwitterStreamUploader:
                 logging.info(f"Athena region {self.aws_region} differs from S3 region {s3_region}. "
                              f"Will not recreate tables.")
             else:
-                athena = AthenaDatabase(s3_output=self.s3_bucket, database=self.athena_db)
-
-                logging.info("Drop tables if they exist")
-                athena.query_athena_and_wait(query_string="drop table if exists twitter_stream")
-                athena.query_athena_and_wait(query_string="drop table if exists twitter_stream_raw")
-
-                logging.info("Recreate tables")
-                athena.query_athena_and_wait(
-                    query_string=ATHENA_CREATE_TWITTER_STREAM.format(
-                        structure=STRUCTURE_TWEET_ATHENA,
-                        bucket="s3://{}/twitter_stream/".format(self.s3_bucket)))
-                athena.query_athena_and_wait(
-                    query_string=ATHENA_CREATE_TWITTER_STREAM_RAW.format(
-                        structure=STRUCTURE_TWEET_ATHENA,
-                        bucket="s3://{}/twitter_stream_raw/".format(self.s3_bucket)))
-
-                logging.info("Add new partitions")
-                athena.query_athena_and_wait(query_string="MSCK REPAIR TABLE twitter_stream")
-                athena.query_athena_and_wait(query_string="MSCK REPAIR TABLE twitter_stream_raw")
+                if athena is None:
+                    athena = AthenaDatabase(s3_output=self.s3_bucket, database=self.athena_db)
+                if ddl_cache is None:
+                    ddl_cache = AthenaDdlCache(s3_bucket=self.s3_bucket, athena_db=self.athena_db)
+                athena_prefix = self.__read_athena_prefix()
+                with METRICS.stage('athena', filter=athena_prefix['filter']):
+                    run_concurrently(
+                        lambda: self.__update_table(athena, ddl_cache, 'twitter_stream',
+                                                    ATHENA_CREATE_TWITTER_STREAM, athena_prefix),
+                        lambda: self.__update_table(athena, ddl_cache, 'twitter_stream_raw',
+                                                    ATHENA_CREATE_TWITTER_STREAM_RAW, athena_prefix))
         logging.info("END: Recreate Athena tables for twitter_stream")
 
 
+def create_uploader(config, work_dir=None):
+    return TwitterStreamUploader(s3_bucket=config['aws']['s3-data'],
+                                 athena_db=config['aws']['athena-data'],
+                                 aws_region=config['aws']['default_region'],
+                                 compression=config['twitter_stream'].get('compression', 'bz2'),
+                                 segmented=bool(config['twitter_stream'].get('rotation_minutes')
+                                                or config['twitter_stream'].get('rotation_tweets')),
+                                 part_size_mb=config['twitter_stream'].get('upload_part_size_mb',
+                                                                           MultipartUploader.DEFAULT_PART_SIZE_MB),
+                                 upload_concurrency=config['twitter_stream'].get(
+                                     'upload_concurrency', MultipartUploader.DEFAULT_CONCURRENCY),
+                                 partition_mode=config['twitter_stream'].get('athena_partitions', 'add'),
+                                 work_dir=work_dir,
+                                 hourly=config['twitter_stream'].get('hourly_partitions', False),
+                                 stream_export=config['twitter_stream'].get('stream_export', False),
+                                 compression_workers=config['twitter_stream'].get('compression_workers'),
+                                 orc_options=orc_options(config))
+
+
+def orc_options(config):
+    # ORCWriter options; bloom filters on id and user.id help Athena skip row groups on lookups by id
+    return {'stripe_size': config['twitter_stream'].get('orc_stripe_size_mb',
+                                                        OrcTweetWriter.DEFAULT_STRIPE_SIZE_MB) * 2 ** 20,
+            'row_index_stride': config['twitter_stream'].get('orc_row_index_stride',
+                                                             OrcTweetWriter.DEFAULT_ROW_INDEX_STRIDE),
+            'bloom_filter_columns': config['twitter_stream'].get('orc_bloom_filter_columns', []),
+            'bloom_filter_fpp': config['twitter_stream'].get('orc_bloom_filter_fpp',
+                                                             OrcTweetWriter.DEFAULT_BLOOM_FILTER_FPP)}
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='S3 Bucket with configuration', required=True)
     args = parser.parse_args()
 
     config = read_dict_from_s3_url(url=args.config)
+    set_s3_endpoint(config['aws'].get('s3_endpoint_url'))
     logger = AthenaLogger(app_name="twitter_stream",
                           s3_bucket=config['aws']['s3-admin'],
                           athena_db=config['aws']['athena-admin'])
     try:
-        twitter_stream_uploader = TwitterStreamUploader(s3_bucket=config['aws']['s3-data'],
-                                                        athena_db=config['aws']['athena-data'],
-                                                        aws_region=config['aws']['default_region'])
-        saved_twitter_stream = twitter_stream_uploader.save_to_s3(delay=config['twitter_stream']['delay'])
-
-        twitter_filter = TwitterFilter(twitter_filter=config['twitter_filter'],
-                                       s3_bucket=config['aws']['s3-data'],
-                                       athena_db=config['aws']['athena-data'])
-        twitter_filter.save_to_s3()
-
-        if saved_twitter_stream:
-            twitter_stream_uploader.recreate_athena_table()
-        twitter_filter.recreate_athena_table()
+        configure_profiler(config, Path(Path(__file__).parent, 'tmp', 'profile'))
+        if config['twitter_stream'].get('daemon'):
+            logging.info("Daemon mode: every day was uploaded when it ended, nothing to upload")
+            return
+        uploaders = []
+        filters = []
+        for twitter_filter, credentials, work_dir in twitter_filters(config):
+            uploaders.append(create_uploader(config, work_dir))
+            filters.append(TwitterFilter(twitter_filter=twitter_filter,
+                                         s3_bucket=config['aws']['s3-data'],
+                                         athena_db=config['aws']['athena-data']))
+        # every filter has its own files, so all of them are uploaded at the same time
+        saved_twitter_stream = run_concurrently(
+            *[lambda uploader=uploader: uploader.save_to_s3(delay=config['twitter_stream']['delay'])
+              for uploader in uploaders],
+            *[twitter_filter.save_to_s3 for twitter_filter in filters])
+        uploaders = [uploader for uploader, uploaded in zip(uploaders, saved_twitter_stream) if uploaded]
+
+        # the tables are shared by all filters: the first uploader creates them if their DDL changed
+        # and only then the others add their partitions, so no one drops a table that is in use
+        if uploaders:
+            run_concurrently(uploaders[0].recreate_athena_table, filters[0].recreate_athena_table)
+            if len(uploaders) > 1:
+                run_concurrently(*[uploader.recreate_athena_table for uploader in uploaders[1:]])
+        else:
+            filters[0].recreate_athena_table()
 
         total, used, free = shutil.disk_usage("/")
         logging.info("Disk Usage: total: %.1f Gb - used: %.1f Gb - free: %.1f Gb",